@@ -0,0 +1,201 @@
+"""In-process fake LDAP directory
+
+FakeDirectory implements the part of the simpleldap interface that
+LdapController uses, so it can be passed as ldap_impl:
+
+    directory = FakeDirectory()
+    directory.add('cn=dotkom,ou=groups,dc=example', objectClass=['posixGroup'],
+                  cn=['dotkom'], memberUid=['norangsh'])
+    controller = LdapController(directory)
+
+It understands the usual search filters (&, |, !, equality, presence,
+substrings, >= and <=) and keeps modifyTimestamp up to date. It is used
+by the tests and by the benchmark_sync command.
+"""
+import random
+import re
+import threading
+import time
+
+OPERATIONAL_ATTRIBUTES = ('modifyTimestamp', 'createTimestamp')
+
+# Same values as ldap.SCOPE_*
+SCOPE_BASE, SCOPE_ONELEVEL, SCOPE_SUBTREE = 0, 1, 2
+
+
+def generalized_time(timestamp=None):
+    """Formats a unix time as LDAP generalized time"""
+    return time.strftime('%Y%m%d%H%M%SZ', time.gmtime(timestamp if timestamp is not None else time.time()))
+
+
+class FilterSyntaxError(ValueError):
+    pass
+
+
+def _unescape(value):
+    return re.sub(r'\\([0-9a-fA-F]{2})', lambda match: chr(int(match.group(1), 16)), value)
+
+
+def compile_filter(ldap_filter):
+    """Compiles an LDAP filter string into a predicate on attribute dicts"""
+    predicate, position = _parse(ldap_filter.strip(), 0)
+    if position != len(ldap_filter.strip()):
+        raise FilterSyntaxError('Trailing characters in filter %r' % ldap_filter)
+    return predicate
+
+
+def _parse(text, position):
+    if position >= len(text) or text[position] != '(':
+        raise FilterSyntaxError('Expected ( at %d in %r' % (position, text))
+    position += 1
+    operator = text[position:position + 1]
+    if operator in ('&', '|'):
+        predicates = []
+        position += 1
+        while text[position:position + 1] == '(':
+            predicate, position = _parse(text, position)
+            predicates.append(predicate)
+        combine = all if operator == '&' else any
+        predicate = lambda entry, predicates=predicates: combine(p(entry) for p in predicates)
+    elif operator == '!':
+        inner, position = _parse(text, position + 1)
+        predicate = lambda entry: not inner(entry)
+    else:
+        end = text.find(')', position)
+        if end < 0:
+            raise FilterSyntaxError('Unbalanced parenthesis in %r' % text)
+        predicate = _item(text[position:end])
+        position = end
+    if text[position:position + 1] != ')':
+        raise FilterSyntaxError('Expected ) at %d in %r' % (position, text))
+    return predicate, position + 1
+
+
+def _item(item):
+    match = re.match(r'^([\w.;-]+)(>=|<=|~=|=)(.*)$', item)
+    if not match:
+        raise FilterSyntaxError('Invalid filter item %r' % item)
+    attribute, operator, value = match.groups()
+    attribute = attribute.lower()
+
+    if operator == '=' and value == '*':
+        return lambda entry: bool(_values(entry, attribute))
+    if operator == '=' and '*' in value:
+        pattern = re.compile('^%s$' % '.*'.join(re.escape(_unescape(part).lower()) for part in value.split('*')))
+        return lambda entry: any(pattern.match(x.lower()) for x in _values(entry, attribute))
+
+    value = _unescape(value).lower()
+    if operator == '>=':
+        return lambda entry: any(x.lower() >= value for x in _values(entry, attribute))
+    if operator == '<=':
+        return lambda entry: any(x.lower() <= value for x in _values(entry, attribute))
+    return lambda entry: any(x.lower() == value for x in _values(entry, attribute))
+
+
+def _values(entry, attribute):
+    for key, values in entry.iteritems():
+        if key.lower() == attribute:
+            return values
+    return ()
+
+
+class FakeEntry(dict):
+    """Search result, a dict of attribute -> values with a dn like LDAPItem"""
+    def __init__(self, dn, attributes):
+        super(FakeEntry, self).__init__(attributes)
+        self.dn = dn
+
+
+class FakeConnection(object):
+    def __init__(self, directory):
+        self._directory = directory
+
+    def search(self, filter, base_dn='', attrs=None, scope=SCOPE_SUBTREE):
+        return self._directory.search(filter, base_dn, attrs, scope)
+
+    def close(self):
+        pass
+
+
+class FakeDirectory(object):
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.search_count = 0
+
+    def Connection(self, hostname, port=None, dn='', password='', encryption=None):
+        return FakeConnection(self)
+
+    def add(self, dn, **attributes):
+        now = generalized_time()
+        attributes.setdefault('createTimestamp', [now])
+        attributes.setdefault('modifyTimestamp', [now])
+        with self._lock:
+            self._entries[dn.lower()] = (dn, attributes)
+
+    def modify(self, dn, timestamp=None, **attributes):
+        """Replaces the given attributes and bumps modifyTimestamp"""
+        with self._lock:
+            attributes_old = self._entries[dn.lower()][1]
+            attributes_old.update(attributes)
+            attributes_old['modifyTimestamp'] = [timestamp if timestamp else generalized_time()]
+
+    def delete(self, dn):
+        with self._lock:
+            del self._entries[dn.lower()]
+
+    def search(self, ldap_filter, base_dn='', attributes=None, scope=SCOPE_SUBTREE):
+        predicate = compile_filter(ldap_filter)
+        base_dn = (base_dn or '').lower()
+        depth = base_dn.count(',') + 1 if base_dn else 0
+        with self._lock:
+            self.search_count += 1
+            entries = sorted(self._entries.items())
+
+        results = []
+        for key, (dn, entry) in entries:
+            if base_dn and key != base_dn and not key.endswith(',' + base_dn):
+                continue
+            if scope == SCOPE_BASE and key != base_dn or scope == SCOPE_ONELEVEL and key.count(',') != depth:
+                continue
+            if predicate(entry):
+                results.append(FakeEntry(dn, self._project(entry, attributes)))
+        return results
+
+    def _project(self, entry, attributes):
+        if attributes is None:
+            return dict((key, list(values)) for key, values in entry.iteritems()
+                        if key not in OPERATIONAL_ATTRIBUTES)
+        wanted = set(x.lower() for x in attributes)
+        return dict((key, list(values)) for key, values in entry.iteritems() if key.lower() in wanted)
+
+
+def generate_directory(users, groups, mean_group_size, distribution='uniform',
+                       search_base='dc=example,dc=com', seed=0):
+    """Builds a FakeDirectory with synthetic posixAccounts and posixGroups
+
+    Group sizes are drawn around mean_group_size, either uniformly or
+    from a heavy tailed pareto distribution where a few groups are huge.
+
+    :returns (directory, list of usernames, list of group names)"""
+    generator = random.Random(seed)
+    directory = FakeDirectory()
+
+    usernames = ['user%06d' % i for i in range(users)]
+    for uidnumber, username in enumerate(usernames, 1000):
+        directory.add('uid=%s,ou=people,%s' % (username, search_base),
+                      objectClass=['account', 'posixAccount'], uid=[username], cn=[username],
+                      uidNumber=[str(uidnumber)], displayName=['User %s' % username],
+                      mail=['%s@example.com' % username])
+
+    groupnames = ['group%05d' % i for i in range(groups)]
+    for gidnumber, groupname in enumerate(groupnames, 1000):
+        if distribution == 'pareto':
+            size = int(mean_group_size * generator.paretovariate(2.0) / 2.0)
+        else:
+            size = generator.randint(1, 2 * mean_group_size - 1) if mean_group_size > 1 else mean_group_size
+        members = generator.sample(usernames, min(max(size, 0), users))
+        directory.add('cn=%s,ou=groups,%s' % (groupname, search_base),
+                      objectClass=['posixGroup', 'top'], cn=[groupname],
+                      gidNumber=[str(gidnumber)], memberUid=members)
+    return directory, usernames, groupnames
@@ -0,0 +1,237 @@
+"""Counters and timings for sync_ldap_groups
+
+SyncStats records, for each phase of a sync (ldap_fetch, rt_load, diff,
+apply), the wall time, LDAP requests and entries, SQL queries and the
+rows inserted, updated and deleted in RT.
+
+HotSpotReport ranks the LDAP searches and SQL statements of a run,
+grouped by their text with the values taken out, for sync_ldap_groups
+--profile.
+"""
+import contextlib
+import json
+import logging
+import pstats
+import re
+import threading
+import time
+from StringIO import StringIO
+from collections import OrderedDict
+
+from django.db.backends.util import CursorWrapper
+
+from rt_ldap_sync.state import write_atomically
+
+logger = logging.getLogger('rt_ldap_sync')
+
+COUNTERS = ('ldap_requests', 'ldap_entries', 'db_queries', 'rows_inserted', 'rows_updated', 'rows_deleted')
+
+
+class ObservedCursorWrapper(CursorWrapper):
+    """Cursor wrapper calling observer(sql, seconds) for every statement"""
+    def __init__(self, cursor, db, observers):
+        super(ObservedCursorWrapper, self).__init__(cursor, db)
+        self.observers = observers
+
+    def execute(self, sql, params=()):
+        self.set_dirty()
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self._observe(sql, time.time() - start)
+
+    def executemany(self, sql, param_list):
+        self.set_dirty()
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self._observe(sql, time.time() - start)
+
+    def _observe(self, sql, seconds):
+        for observer in self.observers:
+            observer(sql, seconds)
+
+
+@contextlib.contextmanager
+def observe_queries(connection, *observers):
+    """Calls observer(sql, seconds) for every statement run on a database
+    connection, without keeping the statements around like DEBUG does"""
+    use_debug_cursor, make_debug_cursor = connection.use_debug_cursor, connection.make_debug_cursor
+    connection.use_debug_cursor = True
+    connection.make_debug_cursor = lambda cursor: ObservedCursorWrapper(cursor, connection, observers)
+    try:
+        yield
+    finally:
+        connection.make_debug_cursor = make_debug_cursor
+        connection.use_debug_cursor = use_debug_cursor
+
+
+class SyncStats(object):
+    def __init__(self):
+        self.phases = OrderedDict()
+        self._current = None
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Attributes everything counted inside the block to phase name"""
+        stats = self.phases.setdefault(name, OrderedDict([('wall_time', 0.0)] + [(x, 0) for x in COUNTERS]))
+        previous, self._current = self._current, stats
+        start = time.time()
+        try:
+            yield stats
+        finally:
+            stats['wall_time'] += time.time() - start
+            self._current = previous
+
+    def count(self, counter, amount=1):
+        if self._current is None:
+            return
+        with self._lock:
+            self._current[counter] += amount
+
+    def on_search(self, ldap_filter, base_dn, attributes, seconds, entries):
+        """LdapController search listener"""
+        self.count('ldap_requests')
+        self.count('ldap_entries', entries)
+
+    def on_query(self, sql, seconds):
+        """observe_queries observer"""
+        self.count('db_queries')
+
+    def merge(self, phases):
+        """Adds the phases of another SyncStats, such as a worker process's"""
+        with self._lock:
+            for name, stats in phases.iteritems():
+                merged = self.phases.setdefault(name, OrderedDict([('wall_time', 0.0)] + [(x, 0) for x in COUNTERS]))
+                for key, value in stats.iteritems():
+                    merged[key] += value
+
+    def totals(self):
+        totals = OrderedDict([('wall_time', 0.0)] + [(x, 0) for x in COUNTERS])
+        for stats in self.phases.itervalues():
+            for key, value in stats.iteritems():
+                totals[key] += value
+        return totals
+
+    def as_dict(self):
+        return {'phases': self.phases, 'totals': self.totals()}
+
+    def summary(self):
+        """One line for the log, totals first and then time per phase"""
+        totals = self.totals()
+        parts = ['%s=%s' % (key, value if key != 'wall_time' else '%.3fs' % value)
+                 for key, value in totals.iteritems()]
+        parts.extend('%s=%.3fs' % (name, stats['wall_time']) for name, stats in self.phases.iteritems())
+        return 'sync finished: ' + ' '.join(parts)
+
+    def log_summary(self):
+        logger.info(self.summary())
+
+    def write_json(self, path):
+        write_atomically(path, json.dumps(self.as_dict(), indent=2) + '\n')
+
+    def write_prometheus(self, path):
+        """Writes the stats in the Prometheus text exposition format"""
+        lines = []
+        for key in ('wall_time',) + COUNTERS:
+            metric = 'rt_ldap_sync_' + ('phase_seconds' if key == 'wall_time' else key)
+            lines.append('# TYPE %s gauge' % metric)
+            for name, stats in self.phases.iteritems():
+                lines.append('%s{phase="%s"} %s' % (metric, name, stats[key]))
+        lines.append('# TYPE rt_ldap_sync_last_run_timestamp_seconds gauge')
+        lines.append('rt_ldap_sync_last_run_timestamp_seconds %d' % time.time())
+        write_atomically(path, '\n'.join(lines) + '\n')
+
+
+@contextlib.contextmanager
+def profiled(profiler):
+    """Runs the block under a cProfile.Profile, or unprofiled if profiler is None"""
+    if profiler is None:
+        yield
+        return
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+
+
+_SQL_STRING = re.compile(r"'(?:[^']|'')*'")
+_SQL_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_SQL_PARAMETER = re.compile(r'%s|\?')
+# Values other than the object class, which tells the searches apart
+_FILTER_VALUE = re.compile(r'(?<!objectClass)=[^()]*\)', re.IGNORECASE)
+# A parenthesised list repeated, like the rows of a bulk insert or the terms of an OR filter
+_REPEATED_GROUP = re.compile(r'(\([^()]*\))(?:\s*,?\s*\1)+')
+_REPEATED_VALUE = re.compile(r'\?(?:\s*,\s*\?)+')
+
+
+def normalize_sql(sql):
+    """Statement text with every value replaced by ? and value lists collapsed"""
+    sql = _SQL_PARAMETER.sub('?', _SQL_NUMBER.sub('?', _SQL_STRING.sub('?', sql)))
+    sql = _REPEATED_VALUE.sub('?, ...', sql)
+    return _REPEATED_GROUP.sub(r'\1, ...', sql)
+
+
+def normalize_filter(ldap_filter):
+    """LDAP filter with every assertion value replaced by ? and repeated terms collapsed"""
+    return _REPEATED_GROUP.sub(r'\1...', _FILTER_VALUE.sub('=?)', ldap_filter))
+
+
+class HotSpotReport(object):
+    """Time spent per kind of LDAP search and SQL statement
+
+    An LdapController search listener and an observe_queries observer,
+    each search and statement is counted under its normalized text.
+    """
+    def __init__(self):
+        self.searches = {}
+        self.queries = {}
+        self._lock = threading.Lock()
+
+    def _add(self, totals, key, seconds, entries=0):
+        with self._lock:
+            stats = totals.setdefault(key, [0, 0.0, 0.0, 0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            stats[3] += entries
+
+    def on_search(self, ldap_filter, base_dn, attributes, seconds, entries):
+        attributes = ','.join(attributes) if attributes else '*'
+        self._add(self.searches, '%s base=%s attributes=%s' % (normalize_filter(ldap_filter), base_dn, attributes),
+                  seconds, entries)
+
+    def on_query(self, sql, seconds):
+        self._add(self.queries, normalize_sql(sql), seconds)
+
+    def ranked(self, totals, top=20):
+        """The top entries by total time
+
+        :returns list of (key, count, total seconds, max seconds, entries)"""
+        ranked = sorted(totals.iteritems(), key=lambda (key, stats): stats[1], reverse=True)
+        return [(key,) + tuple(stats) for key, stats in ranked[:top]]
+
+    def report(self, profiler=None, top=20):
+        """Plain text report of the top LDAP searches, SQL statements and
+        Python functions of profiler by cumulative time"""
+        lines = ['LDAP searches by total time', '%8s %10s %10s %10s  %s' % ('count', 'total s', 'max s', 'entries', 'search')]
+        for key, count, total, longest, entries in self.ranked(self.searches, top):
+            lines.append('%8d %10.3f %10.3f %10d  %s' % (count, total, longest, entries, key))
+        lines.extend(['', 'SQL statements by total time', '%8s %10s %10s  %s' % ('count', 'total s', 'max s', 'statement')])
+        for key, count, total, longest, entries in self.ranked(self.queries, top):
+            lines.append('%8d %10.3f %10.3f  %s' % (count, total, longest, key))
+        if profiler is not None:
+            stream = StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(top)
+            lines.extend(['', 'Python functions by cumulative time', stream.getvalue()])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, profiler=None, top=20):
+        """Writes the report to path, and the raw profile for pstats or snakeviz to path.prof"""
+        if profiler is not None:
+            profiler.dump_stats(path + '.prof')
+        write_atomically(path, self.report(profiler, top))
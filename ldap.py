@@ -1,12 +1,454 @@
 """Tiny LDAP Wrapper module"""
+from __future__ import absolute_import
+
+import contextlib
+import threading
+import time
+import Queue
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+import ldap
+import ldap.dn
+from ldap.controls import SimplePagedResultsControl
+from ldap.filter import escape_filter_chars
 import simpleldap
+from rt_ldap_sync.matrix import MembershipMatrix
+from rt_ldap_sync.nested import GroupGraph
+try:
+    from ldap.controls.psearch import PersistentSearchControl, EntryChangeNotificationControl, CHANGE_TYPES_INT
+except ImportError:
+    # python-ldap needs pyasn1 for these, watchers fall back to polling
+    PersistentSearchControl = None
+
+# Entries per page requested with the simple paged results control
+DEFAULT_PAGE_SIZE = 500
+# Connections LdapController opens for concurrent searches
+DEFAULT_POOL_SIZE = 4
+# Names put in one (|(cn=a)(cn=b)...) filter
+DEFAULT_FILTER_CHUNK_SIZE = 100
+# Searches kept by a SearchCache
+DEFAULT_CACHE_SIZE = 1000
+# Searches a SearchPipeline has waiting for the server at once
+DEFAULT_MAX_OUTSTANDING = 8
+
+
+def is_connection_alive(connection):
+    """Default pool health check, asks a simpleldap connection who we are"""
+    if isinstance(connection, simpleldap.Connection):
+        try:
+            connection.connection.whoami_s()
+        except ldap.LDAPError:
+            return False
+    return True
+
+
+class LdapConnectionPool(object):
+    """Bounded pool of LDAP connections
+
+    Connections are opened lazily with connection_factory, at most size
+    of them, and checked with health_check before being handed out again.
+    """
+    def __init__(self, connection_factory, size=DEFAULT_POOL_SIZE, health_check=is_connection_alive):
+        if size < 1:
+            raise ValueError('A pool needs room for at least one connection')
+        self._connection_factory = connection_factory
+        self._health_check = health_check
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = Queue.LifoQueue()
+        self.size = size
+
+    def checkout(self):
+        """Returns an idle healthy connection or a new one,
+        blocking while all connections are checked out"""
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    connection = self._idle.get_nowait()
+                except Queue.Empty:
+                    return self._connection_factory()
+                if self._health_check(connection):
+                    return connection
+                self._discard(connection)
+        except:
+            self._slots.release()
+            raise
+
+    def checkin(self, connection, broken=False):
+        """Returns a connection to the pool, closing it if broken"""
+        if broken:
+            self._discard(connection)
+        else:
+            self._idle.put(connection)
+        self._slots.release()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """A connection checked back in however the block ends, as broken if the server went away"""
+        connection = self.checkout()
+        broken = False
+        try:
+            yield connection
+        except ldap.SERVER_DOWN:
+            broken = True
+            raise
+        finally:
+            self.checkin(connection, broken)
+
+    def close(self):
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except Queue.Empty:
+                return
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except ldap.LDAPError:
+            pass
+
+
+class SearchCache(object):
+    """Bounded LRU cache of search results, each kept for ttl seconds
+
+    Searches that found nothing are cached too, for negative_ttl seconds,
+    so lookups of entries missing in the directory don't reach it either.
+    A ttl of 0 turns the kind of caching off.
+    """
+    def __init__(self, ttl, max_entries=DEFAULT_CACHE_SIZE, negative_ttl=None, clock=time.time):
+        if max_entries < 1:
+            raise ValueError('A cache needs room for at least one search')
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.max_entries = max_entries
+        self.hits = self.misses = self.evictions = 0
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """The cached results of a search, None when missing or expired"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= self._clock():
+                self.misses += 1
+                return None
+            # Most recently used last
+            self._entries[key] = entry
+            self.hits += 1
+            return list(entry[1])
+
+    def put(self, key, results):
+        ttl = self.ttl if results else self.negative_ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (self._clock() + ttl, list(results))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, base_dn=None):
+        """Drops every search, or the searches whose base is base_dn, or above or below it"""
+        with self._lock:
+            if base_dn is None:
+                self._entries.clear()
+                return
+            base_dn = base_dn.lower()
+            for key in self._entries.keys():
+                search_base = key[1].lower()
+                if search_base == base_dn or search_base.endswith(',' + base_dn) or base_dn.endswith(',' + search_base):
+                    del self._entries[key]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self)}
+
+
+class PendingSearch(object):
+    """A search sent to the server, returned by LdapController.start_search
+
+    The server works on it while the caller does other things, like
+    querying RT. result() waits for all of it, iterating yields the
+    entries page by page as they arrive. Both raise the LDAPError the
+    search failed with, if any.
+    """
+    def __init__(self, pipeline, search, results=None, validate=None):
+        self.search = search
+        self.done = results is not None
+        self.error = None
+        self.retried = False
+        self.connection = None
+        self.msgid = None
+        self.started = None
+        self._pipeline = pipeline
+        self._entries = list(results) if results is not None else []
+        self._validate = validate
+
+    def result(self):
+        """All entries of the search, waiting for the rest"""
+        while not self.done:
+            self._pipeline.wait(self)
+        if self.error is not None:
+            raise self.error
+        if self._validate:
+            self._validate(self._entries)
+        return list(self._entries)
+
+    def __iter__(self):
+        position = 0
+        while True:
+            while position < len(self._entries):
+                yield self._entries[position]
+                position += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            self._pipeline.wait(self)
+
+
+class SearchPipeline(object):
+    """Many searches waiting for the server at once, over a few connections, without threads
+
+    Uses python-ldap's asynchronous operations: search_ext sends a search
+    and returns, result3 collects a page of it later. At most
+    max_outstanding searches are sent at a time, spread over up to
+    connections connections from the controller's pool, the others are
+    sent as earlier ones finish. The connections go back to the pool
+    whenever no search is left, to be health checked before the next.
+
+    A failed search is finished with its error. One that lost its
+    connection before any entries arrived is retried once on a new
+    connection, like search_many does with threads. Not thread safe, a
+    pipeline belongs to the thread using it.
+    """
+    def __init__(self, controller, connections=DEFAULT_POOL_SIZE, max_outstanding=DEFAULT_MAX_OUTSTANDING):
+        if max_outstanding < 1:
+            raise ValueError('A pipeline needs room for at least one search')
+        self.max_outstanding = max_outstanding
+        self._controller = controller
+        self._max_connections = connections
+        self._pool = None
+        self._connections = []
+        self._next_connection = 0
+        self._outstanding = []
+        self._queued = []
+
+    def start(self, search, validate=None):
+        pending = PendingSearch(self, search, validate=validate)
+        if len(self._outstanding) < self.max_outstanding:
+            self._send(pending)
+        else:
+            self._queued.append(pending)
+        return pending
+
+    def wait(self, pending):
+        """Collects the next page of pending, or of the oldest sent search while pending waits its turn"""
+        self._collect(pending if pending.msgid is not None else self._outstanding[0])
+
+    def close(self):
+        """Returns the connections, abandoning the searches not collected"""
+        self._outstanding = []
+        self._queued = []
+        self._release()
+
+    def _release(self):
+        for connection in self._connections:
+            self._pool.checkin(connection)
+        self._connections = []
+
+    def _connection(self):
+        if len(self._connections) < self._max_connections:
+            if self._pool is None:
+                self._pool = self._controller.get_pool()
+            self._connections.append(self._pool.checkout())
+            return self._connections[-1]
+        self._next_connection = (self._next_connection + 1) % len(self._connections)
+        return self._connections[self._next_connection]
+
+    def _send(self, pending, cookie=''):
+        ldap_filter, base_dn, attributes, scope = (tuple(pending.search) + (ldap.SCOPE_SUBTREE,))[:4]
+        if pending.connection is None:
+            try:
+                pending.connection = self._connection()
+            except ldap.LDAPError as e:
+                self._finish(pending, e)
+                return
+            self._outstanding.append(pending)
+        controls = []
+        if self._controller._page_size:
+            controls.append(SimplePagedResultsControl(True, size=self._controller._page_size, cookie=cookie))
+        pending.started = time.time()
+        try:
+            pending.msgid = pending.connection.connection.search_ext(base_dn, scope, ldap_filter, attributes,
+                                                                     serverctrls=controls)
+        except ldap.LDAPError as e:
+            self._fail(pending, e)
+
+    def _collect(self, pending):
+        try:
+            rtype, rdata, rmsgid, serverctrls = pending.connection.connection.result3(pending.msgid)
+        except ldap.LDAPError as e:
+            self._fail(pending, e)
+            return
+        ldap_filter, base_dn, attributes = pending.search[:3]
+        self._controller._notify_search(ldap_filter, base_dn, attributes, time.time() - pending.started, len(rdata))
+        pending._entries.extend(pending.connection.to_items(rdata))
+
+        cookies = [ctrl.cookie for ctrl in serverctrls or []
+                   if ctrl.controlType == SimplePagedResultsControl.controlType]
+        if cookies and cookies[0]:
+            self._send(pending, cookies[0])
+            return
+        self._finish(pending)
+
+    def _fail(self, pending, error):
+        """Finishes a failed search, or retries it and the others on its connection if the server went away"""
+        if not isinstance(error, ldap.SERVER_DOWN):
+            self._finish(pending, error)
+            return
+
+        connection = pending.connection
+        self._connections.remove(connection)
+        self._pool.checkin(connection, broken=True)
+        lost = [other for other in self._outstanding if other.connection is connection]
+        for other in lost:
+            self._outstanding.remove(other)
+            other.connection = other.msgid = None
+        # Entries already handed out would be repeated by a retry
+        for other in lost:
+            if not other.retried and not other._entries:
+                other.retried = True
+                self._send(other)
+        for other in lost:
+            if other.connection is None and not other.done:
+                self._finish(other, error)
+
+    def _finish(self, pending, error=None):
+        pending.done = True
+        pending.msgid = None
+        pending.error = error
+        if pending in self._outstanding:
+            self._outstanding.remove(pending)
+        if error is None:
+            self._controller._search_done(pending.search, pending._entries)
+        if self._queued:
+            self._send(self._queued.pop(0))
+        elif not self._outstanding:
+            self._release()
+
+
+class SearchProfile(object):
+    """Where a kind of entry lives and which attributes the sync reads
+
+    The filters are built from the profile once, values put into them
+    are escaped as RFC 4515 requires.
+
+    :base_dn relative to the controller's search base, '' for the base itself
+    :attributes attributes requested, id and member attribute if None"""
+    def __init__(self, object_class, id_attribute, member_attribute=None, base_dn='',
+                 scope=ldap.SCOPE_SUBTREE, attributes=None):
+        self.object_class = object_class
+        self.id_attribute = id_attribute
+        self.member_attribute = member_attribute
+        self.base_dn = base_dn
+        self.scope = scope
+        self._attributes = attributes
+        if attributes is None:
+            attributes = [x for x in (id_attribute, member_attribute) if x]
+        self.attributes = list(attributes)
+
+        object_filter = '(objectClass=%s)' % escape_filter_chars(object_class)
+        self._all_filter = object_filter
+        self._with_id_filter = '(&%s(%s=*))' % (object_filter, id_attribute)
+        self._id_template = '(&%s(&(%s=%%s)))' % (object_filter, id_attribute)
+        self._member_template = '(&%s(&(%s=*)(%s=%%s)))' % (object_filter, id_attribute, member_attribute)
+        self._any_id_template = '(&%s(|%%s))' % object_filter
+        self._id_item_template = '(%s=%%s)' % id_attribute
+        self._changed_template = '(&%s(modifyTimestamp>=%%s))' % object_filter
+
+    def replace(self, **options):
+        """A copy of the profile with some settings changed"""
+        settings = dict((key, getattr(self, key)) for key in ('object_class', 'id_attribute', 'member_attribute',
+                                                               'base_dn', 'scope'))
+        settings['attributes'] = self._attributes
+        settings.update(options)
+        return SearchProfile(**settings)
+
+    def base(self, search_base):
+        return ','.join(x for x in (self.base_dn, search_base) if x)
+
+    def all_filter(self):
+        return self._all_filter
+
+    def with_id_filter(self):
+        return self._with_id_filter
+
+    def id_filter(self, value):
+        return self._id_template % escape_filter_chars(value)
+
+    def any_id_filter(self, values):
+        """Matches entries with any of the given ids"""
+        return self._any_id_template % ''.join(self._id_item_template % escape_filter_chars(value) for value in values)
+
+    def member_filter(self, value):
+        return self._member_template % escape_filter_chars(value)
+
+    def changed_filter(self, timestamp):
+        return self._changed_template % escape_filter_chars(timestamp)
+
+    def search(self, ldap_filter, search_base, attributes=None):
+        """The (ldap_filter, base_dn, attributes) tuple searches are passed around as,
+        with the scope appended when it isn't a subtree search
+
+        :attributes requested instead of the profile's attributes"""
+        search = (ldap_filter, self.base(search_base), self.attributes if attributes is None else attributes)
+        if self.scope != ldap.SCOPE_SUBTREE:
+            search += (self.scope,)
+        return search
+
+
+# Attributes RT users are provisioned from, see iter_user_records
+USER_REALNAME_ATTRIBUTE = 'displayName'
+USER_EMAIL_ATTRIBUTE = 'mail'
+# posixAccount users, only the attributes the sync reads
+USER_PROFILE = SearchProfile('posixAccount', 'uid', attributes=['uid', USER_REALNAME_ATTRIBUTE, USER_EMAIL_ATTRIBUTE])
+# posixGroup groups under ou=groups
+GROUP_PROFILE = SearchProfile('posixGroup', 'cn', 'memberUid', base_dn='ou=groups')
+# groupOfNames groups whose member DNs are users or other groups
+NESTED_GROUP_PROFILE = SearchProfile('groupOfNames', 'cn', 'member', base_dn='ou=groups')
+
 
 class LdapController(object):
-    def __init__(self, ldap_impl=None):
+    def __init__(self, ldap_impl=None, page_size=DEFAULT_PAGE_SIZE, pool_size=DEFAULT_POOL_SIZE,
+                 user_profile=USER_PROFILE, group_profile=GROUP_PROFILE, nested_group_profile=None, cache=None,
+                 max_outstanding=DEFAULT_MAX_OUTSTANDING):
         self._connection = None
+        self._pool = None
+        self._watch = None
         self._search_base = None
         self._encryption = None
         self._protocol = None
+        self._page_size = page_size
+        self._pool_size = pool_size
+        self._max_outstanding = max_outstanding
+        self._pipeline = None
+        self.user_profile = user_profile
+        self.group_profile = group_profile
+        # Nested groups are expanded when set, see get_group_graph
+        self.nested_group_profile = nested_group_profile
+        self._group_graph = None
+        # Called as listener(ldap_filter, base_dn, attributes, seconds, entries)
+        # after every request sent to the server, one per page when paging
+        self.search_listeners = []
+        # SearchCache answering repeated searches, see _get_search_results
+        self.cache = cache
 
         self._ldap_impl = ldap_impl if ldap_impl else simpleldap
 
@@ -41,14 +483,31 @@ class LdapController(object):
 
 
 
-        self._connection = self._ldap_impl.Connection(self.hostname, self.port, '', '', self._encryption )
+        self._connection = self._new_connection()
         return self._connection
 
+    def _new_connection(self):
+        return self._ldap_impl.Connection(self.hostname, self.port, '', '', self._encryption )
 
     def close(self):
         if self._connection:
             self._connection.close()
         self._connection = None
+        if self._pipeline:
+            self._pipeline.close()
+        self._pipeline = None
+        if self._pool:
+            self._pool.close()
+        self._pool = None
+        if self._watch:
+            self._watch[0].close()
+        self._watch = None
+        self._group_graph = None
+
+    def invalidate_cache(self, base_dn=None):
+        """Forgets cached searches, see SearchCache.invalidate"""
+        if self.cache is not None:
+            self.cache.invalidate(base_dn)
 
     def is_connected(self):
         """are we connected to LDAP server?
@@ -61,102 +520,458 @@ class LdapController(object):
         return self._connection
 
 
-    def _get_search_results(self, ldap_filter, base_dn, attributes):
-        return self.get_connection().search(ldap_filter, base_dn, attributes)
+    def get_pool(self):
+        """Pool of extra connections used by search_many, opened on demand"""
+        if not self.is_connected():
+            raise simpleldap.ConnectionException('You need to be connected')
+        if not self._pool:
+            self._pool = LdapConnectionPool(self._new_connection, self._pool_size)
+        return self._pool
+
+    def get_pipeline(self):
+        """SearchPipeline over the pool's connections, used by start_search"""
+        if not self._pipeline:
+            self._pipeline = SearchPipeline(self, self._pool_size, self._max_outstanding)
+        return self._pipeline
+
+    def start_search(self, ldap_filter, base_dn, attributes, scope=ldap.SCOPE_SUBTREE, validate=None):
+        """Sends a search without waiting for it, see PendingSearch
+
+        Searches on simpleldap connections go through the pipeline, so any
+        number can be outstanding without threads. Other ldap_impl
+        connections, and searches answered by the cache, are done at once.
+
+        :validate called with the entries before result() returns them"""
+        if not self.is_connected():
+            raise simpleldap.ConnectionException('You need to be connected')
+        search = (ldap_filter, base_dn, attributes, scope)
+        if not isinstance(self.get_connection(), simpleldap.Connection):
+            return PendingSearch(None, search, self._get_search_results(*search), validate)
+        if self.cache is not None:
+            results = self.cache.get(self._cache_key(*search))
+            if results is not None:
+                return PendingSearch(None, search, results, validate)
+        return self.get_pipeline().start(search, validate)
+
+    def _search_done(self, search, results):
+        """Called by the pipeline with the results of a finished search"""
+        if self.cache is not None:
+            self.cache.put(self._cache_key(*search), results)
+
+    def search_many(self, searches):
+        """Runs searches concurrently
+
+        Pipelined over the connection pool with simpleldap connections,
+        see start_search. Other ldap_impl connections get a thread per
+        pooled connection, where a search that loses its connection is
+        retried once on a new one.
+
+        :searches list of (ldap_filter, base_dn, attributes[, scope])
+        :returns list with the results of each search, in the same order"""
+        searches = list(searches)
+        if len(searches) < 2:
+            return [self._get_search_results(*search) for search in searches]
+        if isinstance(self.get_connection(), simpleldap.Connection):
+            return [pending.result() for pending in [self.start_search(*search) for search in searches]]
+
+        pool = self.get_pool()
+
+        def run(search):
+            try:
+                with pool.connection() as connection:
+                    return self._get_search_results(*search, connection=connection)
+            except ldap.SERVER_DOWN:
+                with pool.connection() as connection:
+                    return self._get_search_results(*search, connection=connection)
+
+        threads = ThreadPool(min(pool.size, len(searches)))
+        try:
+            return threads.map(run, searches)
+        finally:
+            threads.close()
+            threads.join()
+
+    def _get_search_results(self, ldap_filter, base_dn, attributes, scope=ldap.SCOPE_SUBTREE, connection=None,
+                            use_cache=True):
+        """All results of a search, from the cache if the controller has one
+
+        The iter_ methods stream their results and are never cached."""
+        cache = self.cache if use_cache else None
+        key = self._cache_key(ldap_filter, base_dn, attributes, scope)
+        if cache is not None:
+            results = cache.get(key)
+            if results is not None:
+                return results
+        results = list(self._iter_search_results(ldap_filter, base_dn, attributes, scope, connection))
+        if cache is not None:
+            cache.put(key, results)
+        return results
+
+    def _cache_key(self, ldap_filter, base_dn, attributes, scope=ldap.SCOPE_SUBTREE):
+        return (ldap_filter, base_dn, tuple(attributes) if attributes is not None else None, scope)
+
+    def _iter_search_results(self, ldap_filter, base_dn, attributes, scope=ldap.SCOPE_SUBTREE, connection=None):
+        """Yields search results one page at a time
+
+        Uses the simple paged results control (RFC 2696) on simpleldap
+        connections, so neither the server size limit nor our memory
+        limits how many entries a search can return. Other ldap_impl
+        connections, and a page size of 0, get a single plain search."""
+        connection = connection if connection else self.get_connection()
+        if not self._page_size or not isinstance(connection, simpleldap.Connection):
+            start = time.time()
+            if scope == ldap.SCOPE_SUBTREE:
+                results = connection.search(ldap_filter, base_dn, attributes)
+            else:
+                results = connection.search(ldap_filter, base_dn, attributes, scope=scope)
+            self._notify_search(ldap_filter, base_dn, attributes, time.time() - start, len(results))
+            for item in results:
+                yield item
+            return
+
+        control = SimplePagedResultsControl(True, size=self._page_size, cookie='')
+        while True:
+            start = time.time()
+            msgid = connection.connection.search_ext(base_dn, scope, ldap_filter, attributes,
+                                                     serverctrls=[control])
+            rtype, rdata, rmsgid, serverctrls = connection.connection.result3(msgid)
+            self._notify_search(ldap_filter, base_dn, attributes, time.time() - start, len(rdata))
+            for item in connection.to_items(rdata):
+                yield item
+
+            cookies = [ctrl.cookie for ctrl in serverctrls
+                       if ctrl.controlType == SimplePagedResultsControl.controlType]
+            if not cookies or not cookies[0]:
+                return
+            control.cookie = cookies[0]
+
+    def _notify_search(self, ldap_filter, base_dn, attributes, seconds, entries):
+        for listener in self.search_listeners:
+            listener(ldap_filter, base_dn, attributes, seconds, entries)
+
+    def _profile(self, profile, search_options):
+        """profile with search_options, a dict of SearchProfile settings, applied"""
+        return profile.replace(**search_options) if search_options else profile
+
+    def _users_search(self, search_options=None):
+        profile = self._profile(self.user_profile, search_options)
+        return profile.search(profile.all_filter(), self._search_base)
 
     def get_users(self, search_options=None):
         """Get users from LDAP
 
-        :search_options may contain search parameters as:
+        :search_options dict overriding settings of user_profile, see SearchProfile:
 
-        BaseDN, isUserSubTree?, ObjectClass required, UserFilter
-        UserIDAttribute, RealNameAttribute, EmailAttribute
+        base_dn, scope, object_class, id_attribute, attributes
         """
+        if self.is_connected():
+            return self._get_search_results(*self._users_search(search_options))
+        else:
+            raise simpleldap.ConnectionException('You need to be connected')
 
-        #base_dn_users = 'ou=people'
-        base_dn_users = self._search_base
-        #filter_object_class = '(objectClass=inetOrgPerson)'
-        filter_object_class = '(objectClass=posixAccount)'
-        attribute_user_id = 'uid'
-        attribute_real_name = 'displayName'
-        attribute_email = 'mail'
+    def iter_users(self, search_options=None):
+        """Like get_users, but yields the users page by page"""
+        if self.is_connected():
+            return self._iter_search_results(*self._users_search(search_options))
+        else:
+            raise simpleldap.ConnectionException('You need to be connected')
 
+    def start_users(self, search_options=None):
+        """Like get_users, but returns a PendingSearch at once"""
+        return self.start_search(*self._users_search(search_options))
+
+    def iter_user_records(self, usernames=None, search_options=None):
+        """Streams users as the (name, realname, emailaddress) RT is provisioned with
+
+        :usernames only yield these users
+        :returns iterator of unicode tuples, '' for missing attributes"""
+        profile = self._profile(self.user_profile, search_options)
+        for user in self.iter_users(search_options):
+            names = user.get(profile.id_attribute, [])
+            if not names or usernames is not None and names[0] not in usernames:
+                continue
+            values = [user.get(attribute, [''])[0]
+                      for attribute in (profile.id_attribute, USER_REALNAME_ATTRIBUTE, USER_EMAIL_ATTRIBUTE)]
+            # python-ldap returns UTF-8 encoded str
+            yield tuple(value if isinstance(value, unicode) else value.decode('utf-8') for value in values)
+
+    def _groups_all_search(self, search_options=None):
+        profile = self._profile(self.group_profile, search_options)
+        return profile.search(profile.all_filter(), self._search_base, [profile.id_attribute, 'modifyTimestamp'])
+
+    def get_groups_all(self, search_options=None):
         if self.is_connected():
-            return self._get_search_results(filter_object_class, base_dn_users, None)
+            return self._get_search_results(*self._groups_all_search(search_options))
         else:
             raise simpleldap.ConnectionException('You need to be connected')
 
-    def get_groups_all(self):
-        filter_object_class = 'posixGroup'
-        base_dn_group = 'ou=groups'
+    def iter_groups_all(self, search_options=None):
+        """Like get_groups_all, but yields the groups page by page"""
+        if self.is_connected():
+            return self._iter_search_results(*self._groups_all_search(search_options))
+        else:
+            raise simpleldap.ConnectionException('You need to be connected')
+
+    def start_groups_all(self, search_options=None):
+        """Like get_groups_all, but returns a PendingSearch at once"""
+        return self.start_search(*self._groups_all_search(search_options))
 
-        ldap_filter = "(objectClass={0})".format(filter_object_class)
-        base_filter = "{0},{1}".format(base_dn_group, self._search_base)
+    def _groups_changed_search(self, timestamp=None, search_options=None):
+        profile = self._profile(self.group_profile, search_options)
+        ldap_filter = profile.changed_filter(timestamp) if timestamp else profile.all_filter()
+        return profile.search(ldap_filter, self._search_base, profile.attributes + ['modifyTimestamp'])
 
+    def get_groups_changed_since(self, timestamp, search_options=None):
+        """Get groups modified since a given time
+
+        :timestamp LDAP generalized time, e.g. 20121231235959Z, as
+        found in the modifyTimestamp of a previous search
+        :returns the changed groups with cn, memberUid and modifyTimestamp"""
         if self.is_connected():
-            print ldap_filter, base_filter, ['cn']
-            return self._get_search_results(ldap_filter, base_filter, ['cn'])
+            # Polling repeats the same filter until a group changes, it must reach the server
+            return self._get_search_results(*self._groups_changed_search(timestamp, search_options), use_cache=False)
         else:
             raise simpleldap.ConnectionException('You need to be connected')
 
+    def supports_persistent_search(self):
+        """Can iter_group_changes be used with this connection?"""
+        return PersistentSearchControl is not None and isinstance(self.get_connection(), simpleldap.Connection)
+
+    def start_group_changes(self):
+        """Sends the persistent search iter_group_changes reads, unless it is running
+
+        It only reports changes made after it started.
+
+        :returns True if it was sent, False if it was already running"""
+        if not self.is_connected():
+            raise simpleldap.ConnectionException('You need to be connected')
+        if self._watch:
+            return False
+
+        connection = self._new_connection()
+        control = PersistentSearchControl(criticality=True, changeTypes=['add', 'delete', 'modify', 'modDN'],
+                                          changesOnly=True, returnECs=True)
+        ldap_filter, base_filter, attributes = self._groups_changed_search()[:3]
+        try:
+            msgid = connection.connection.search_ext(base_filter, self.group_profile.scope, ldap_filter, attributes,
+                                                     serverctrls=[control])
+        except ldap.LDAPError:
+            connection.close()
+            raise
+        self._watch = (connection, msgid)
+        return True
+
+    def iter_group_changes(self, timeout):
+        """Yields groups as they change, for up to timeout seconds
+
+        Uses a persistent search (draft-ietf-ldapext-psearch) on a
+        connection of its own, kept open between calls, started by
+        start_group_changes if it isn't running. Deleted groups are
+        yielded with their cn and no memberUid."""
+        self.start_group_changes()
+        connection, msgid = self._watch
+
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                rtype, rdata, rmsgid, rctrls, rname, rvalue = connection.connection.result4(
+                    msgid, all=0, timeout=max(deadline - time.time(), 0.01), add_ctrls=1, add_intermediates=1,
+                    resp_ctrl_classes={EntryChangeNotificationControl.controlType: EntryChangeNotificationControl})
+            except ldap.TIMEOUT:
+                return
+            except ldap.LDAPError:
+                connection.close()
+                self._watch = None
+                raise
+            if rtype is None:
+                return
+
+            for dn, attributes, controls in rdata:
+                change_types = [ctrl.changeType for ctrl in controls
+                                if ctrl.controlType == EntryChangeNotificationControl.controlType]
+                if change_types and change_types[0] == CHANGE_TYPES_INT['delete']:
+                    attributes = {self.group_profile.id_attribute: [ldap.dn.str2dn(dn)[0][0][1]],
+                                  self.group_profile.member_attribute: []}
+                for item in connection.to_items([(dn, attributes)]):
+                    yield item
+
+    def get_membership_index(self, search_options=None):
+        """Get group membership for every user in one search
+
+        Fetches every posixGroup with its members and inverts it,
+        so the sync doesn't need one get_groups() search per user.
+
+        :returns dict mapping username -> set of group names"""
+        index = {}
+        for username, groupname in self.iter_membership_pairs(search_options):
+            index.setdefault(username, set()).add(groupname)
+        return index
+
+    def get_membership_matrix(self, search_options=None):
+        """Like get_membership_index, as a compact matrix.MembershipMatrix
+        of username -> group names"""
+        return MembershipMatrix.from_pairs(self.iter_membership_pairs(search_options))
+
+    def iter_membership_pairs(self, search_options=None):
+        """Streams every posixGroup membership from one paged search
+
+        With nested_group_profile set the memberships come from
+        get_group_graph() instead, expanded through nested groups.
+
+        :returns iterator of (username, group name) tuples"""
+        if self.nested_group_profile:
+            for groupname, usernames in self.get_group_graph().expand().iteritems():
+                for username in usernames:
+                    yield username, groupname
+            return
+
+        profile = self._profile(self.group_profile, search_options)
+        search = profile.search(profile.with_id_filter(), self._search_base,
+                                [profile.id_attribute, profile.member_attribute])
+
+        if not self.is_connected():
+            raise simpleldap.ConnectionException('You need to be connected')
+
+        for group in self._iter_search_results(*search):
+            for groupname in group.get(profile.id_attribute, []):
+                for username in group.get(profile.member_attribute, []):
+                    yield username, groupname
+
+    def get_group_graph(self):
+        """Get every group with its direct members, users and nested groups
+
+        posixGroups and nested_group_profile groups are fetched with one
+        search each. Member DNs that aren't uid=... DNs are resolved with
+        one more search for all users. The graph is loaded once and kept
+        until close(), expanding it is memoized.
+
+        :returns nested.GroupGraph"""
+        if self._group_graph:
+            return self._group_graph
+        if not self.is_connected():
+            raise simpleldap.ConnectionException('You need to be connected')
+
+        profiles = [self.group_profile, self.nested_group_profile]
+        searches = [profile.search(profile.with_id_filter(), self._search_base) for profile in profiles]
+        posix_groups, nested_groups = self.search_many(searches)
+
+        graph = GroupGraph(self.user_profile.id_attribute)
+        for group in posix_groups:
+            for groupname in group.get(self.group_profile.id_attribute, []):
+                graph.add_group(groupname, getattr(group, 'dn', None),
+                                usernames=group.get(self.group_profile.member_attribute, []))
+        for group in nested_groups:
+            for groupname in group.get(self.nested_group_profile.id_attribute, []):
+                graph.add_group(groupname, getattr(group, 'dn', None),
+                                member_dns=group.get(self.nested_group_profile.member_attribute, []))
+        graph.resolve(self._usernames_by_dn)
+
+        self._group_graph = graph
+        return graph
+
+    def _usernames_by_dn(self, dns):
+        """Looks up the usernames of user DNs, with one search for all users"""
+        profile = self.user_profile
+        usernames = {}
+        for user in self._iter_search_results(*profile.search(profile.all_filter(), self._search_base,
+                                                                  [profile.id_attribute])):
+            for username in user.get(profile.id_attribute, [])[:1]:
+                usernames[user.dn] = username
+        return usernames
+
     def get_groups(self, username, search_options=None):
         """Get group given user name
 
         :username groupmembership for given username
-        :search_options search meta for group fetching:
-
-        GroupTye (Static|Dynamic), BaseDN, Group Subtree,
-        ObjectClass, GroupIDAttribute, GroupMemberAttribute,
-        GroupMemeberFormat"""
-
-        is_group_type_static = True
-        base_dn_group = 'ou=groups'
-        filter_object_class = 'posixGroup'
-        attribute_group_id = 'cn'
-        attribute_member = 'memberUid'
-
-        ldap_filter = "(&(objectClass={0})(&({1}=*)({2}={3})))".format(
-            filter_object_class,
-            attribute_group_id,
-            attribute_member,
-            username
-        )
-        base_filter = "{0},{1}".format(base_dn_group, self._search_base)
+        :search_options dict overriding settings of group_profile, see SearchProfile:
+
+        base_dn, scope, object_class, id_attribute, member_attribute, attributes"""
+        profile = self._profile(self.group_profile, search_options)
 
         if self.is_connected():
-            return self._get_search_results(ldap_filter, base_filter, [attribute_group_id, attribute_member])
+            return self._get_search_results(*profile.search(profile.member_filter(username), self._search_base))
         else:
             raise simpleldap.ConnectionException('You need to be connected')
 
+    def start_groups(self, username, search_options=None):
+        """Like get_groups, but returns a PendingSearch at once"""
+        profile = self._profile(self.group_profile, search_options)
+        return self.start_search(*profile.search(profile.member_filter(username), self._search_base))
+
+    def _groups_member_search(self, groupname, search_options=None):
+        profile = self._profile(self.group_profile, search_options)
+        return profile.search(profile.id_filter(groupname), self._search_base)
+
     def get_groups_member(self, groupname, search_options=None):
-        """Get group given user name
+        """Get group given group name
 
-        :username groupmembership for given username
-        :search_options search meta for group fetching:
+        :groupname the group's id attribute, cn by default
+        :search_options dict overriding settings of group_profile, see get_groups"""
+        if self.is_connected():
+            results = self._get_search_results(*self._groups_member_search(groupname, search_options))
+            self._check_single_group(results)
+            return results
+        else:
+            raise simpleldap.ConnectionException('You need to be connected')
 
-        GroupTye (Static|Dynamic), BaseDN, Group Subtree,
-        ObjectClass, GroupIDAttribute, GroupMemberAttribute,
-        GroupMemeberFormat"""
+    def start_groups_member(self, groupname, search_options=None):
+        """Like get_groups_member, but returns a PendingSearch at once"""
+        return self.start_search(*self._groups_member_search(groupname, search_options),
+                                 validate=self._check_single_group)
 
-        is_group_type_static = True
-        base_dn_group = 'ou=groups'
-        filter_object_class = 'posixGroup'
-        attribute_group_id = 'cn'
-        attribute_member = 'memberUid'
+    def _check_single_group(self, results):
+        if len(results) > 1:
+            raise ValueError('Too many groups returned, be more explicit in your search')
 
-        ldap_filter = "(&(objectClass={0})(&({1}={2})))".format(
-            filter_object_class,
-            attribute_group_id,
-            groupname
-        )
-        base_filter = "{0},{1}".format(base_dn_group, self._search_base)
+    def get_groups_members(self, groupnames, search_options=None):
+        """Get several groups concurrently, see get_groups_member
 
+        :returns dict of group name -> the group's search results"""
+        groupnames = list(groupnames)
+        if not self.is_connected():
+            raise simpleldap.ConnectionException('You need to be connected')
+
+        results = self.search_many(self._groups_member_search(groupname, search_options) for groupname in groupnames)
+        for groupname, result in zip(groupnames, results):
+            if len(result) > 1:
+                raise ValueError('Too many groups returned for {0}, be more explicit in your search'.format(groupname))
+        return dict(zip(groupnames, results))
+
+    def get_members_by_group(self, groupnames, chunk_size=DEFAULT_FILTER_CHUNK_SIZE, search_options=None):
+        """Get the members of many groups in a few searches
+
+        The names are looked up chunk_size at a time with (|(cn=a)(cn=b)...)
+        filters, and the chunks are searched concurrently.
+
+        :returns dict of group name -> set of member usernames, empty for
+        groups not found in LDAP"""
+        groupnames = sorted(set(groupnames))
+        if not self.is_connected():
+            raise simpleldap.ConnectionException('You need to be connected')
+        if self.nested_group_profile:
+            graph = self.get_group_graph()
+            return dict((name, set(graph.members(name))) for name in groupnames)
+
+        profile = self._profile(self.group_profile, search_options)
+        searches = [profile.search(profile.any_id_filter(groupnames[offset:offset + chunk_size]), self._search_base)
+                    for offset in range(0, len(groupnames), chunk_size)]
+
+        # Matching is case insensitive, map entries back to every spelling asked for
+        requested = {}
+        for name in groupnames:
+            requested.setdefault(name.lower(), []).append(name)
+        members = dict((name, set()) for name in groupnames)
+        for results in self.search_many(searches):
+            for group in results:
+                for groupname in group.get(profile.id_attribute, []):
+                    for name in requested.get(groupname.lower(), []):
+                        members[name].update(group.get(profile.member_attribute, []))
+        return members
+
+    def iter_groups_member(self, groupname, search_options=None):
+        """Like get_groups_member, but yields the groups page by page"""
         if self.is_connected():
-            results = self._get_search_results(ldap_filter, base_filter, [attribute_group_id, attribute_member])
-            size_results = len(results)
-            if size_results < 0 or size_results > 1:
-                raise ValueError('Too many groups returned, be more explicit in your search')
-            return results
+            return self._iter_search_results(*self._groups_member_search(groupname, search_options))
         else:
             raise simpleldap.ConnectionException('You need to be connected')
 
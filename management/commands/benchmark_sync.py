@@ -0,0 +1,149 @@
+"""Benchmark sync_ldap_groups management command
+
+Times full and incremental runs of sync_ldap_groups against a synthetic
+directory (see fakeldap.generate_directory) and a freshly created test
+database seeded with the RtUser/RtGroup/RtGroupMember tables, for each
+of the requested user counts. The configured RT database is never
+touched; like the test runner this works on test_<NAME>, or in memory
+with SQLite.
+
+For each size it reports wall time, LDAP requests, SQL queries, rows
+written and the peak resident memory of the process so far.
+"""
+from django.core.management import BaseCommand, CommandError
+from django.db import connections, DEFAULT_DB_ALIAS
+from optparse import make_option
+import json
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+from rt_ldap_sync.fakeldap import generate_directory, generalized_time
+from rt_ldap_sync.management.commands import sync_ldap_groups
+from rt_ldap_sync.models import RtUser, RtGroup, RtGroupMember, RtPrincipal, USER_ID_DEFAULT, PRINCIPAL_USER, DEFAULT_BATCH_SIZE
+from rt_ldap_sync.settings import LDAP_BASE_SEARCH
+
+# Group every synthetic user is a member of, passed as <ldap_group>
+ALL_USERS_GROUP = 'benchmark-all'
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks sync_ldap_groups against a synthetic directory and RT database'
+    option_list = BaseCommand.option_list + (
+        make_option('--users', action='store', dest='users', default='1000,10000,100000',
+                    help='Comma separated list of user counts to benchmark'),
+        make_option('--groups-per-user', action='store', type='float', dest='groups_per_user', default=0.02,
+                    help='Number of groups per user in the directory'),
+        make_option('--group-size', action='store', type='int', dest='group_size', default=50,
+                    help='Mean number of members per group'),
+        make_option('--distribution', action='store', dest='distribution', default='uniform',
+                    help='Group size distribution, uniform or pareto'),
+        make_option('--rt-overlap', action='store', type='float', dest='rt_overlap', default=0.9,
+                    help='Share of the LDAP memberships already present in RT before the run'),
+        make_option('--changed-groups', action='store', type='int', dest='changed_groups', default=10,
+                    help='Groups modified in LDAP before the incremental run'),
+        make_option('--engine', action='store', dest='engine', default='python',
+                    help='sync_ldap_groups --engine used for the full run'),
+        make_option('--seed', action='store', type='int', dest='seed', default=0),
+        make_option('--json', action='store_true', dest='json', default=False,
+                    help='Print the results as JSON'),
+    )
+
+    def handle(self, *args, **options):
+        if options['distribution'] not in ('uniform', 'pareto'):
+            raise CommandError('--distribution must be uniform or pareto')
+        sizes = [int(x) for x in options['users'].split(',') if x.strip()]
+
+        results = []
+        for users in sizes:
+            connection = connections[DEFAULT_DB_ALIAS]
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+            state_directory = tempfile.mkdtemp()
+            try:
+                results.append(self._benchmark(users, os.path.join(state_directory, 'state.json'), options))
+            finally:
+                shutil.rmtree(state_directory)
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2) + '\n')
+        else:
+            for result in results:
+                for run in ('full', 'incremental'):
+                    self.stdout.write('%(users)7d users %(groups)5d groups %(memberships)8d memberships' % result)
+                    self.stdout.write(' %-11s %8.2fs %6d ldap requests %7d queries %8d inserted %8d deleted %7d KiB peak\n' % (
+                        run, result[run]['wall_time'], result[run]['ldap_requests'], result[run]['db_queries'],
+                        result[run]['rows_inserted'], result[run]['rows_deleted'], result[run]['peak_memory_kib']))
+
+    def _benchmark(self, users, state_file, options):
+        generator = random.Random(options['seed'])
+        groups = max(1, int(users * options['groups_per_user']))
+        directory, usernames, groupnames = generate_directory(users, groups, options['group_size'],
+                                                              options['distribution'], LDAP_BASE_SEARCH,
+                                                              options['seed'])
+        directory.add('cn=%s,ou=groups,%s' % (ALL_USERS_GROUP, LDAP_BASE_SEARCH),
+                      objectClass=['posixGroup'], cn=[ALL_USERS_GROUP], memberUid=list(usernames))
+
+        memberships = self._seed_rt(directory, usernames, groupnames, options['rt_overlap'], generator)
+        result = {'users': users, 'groups': groups, 'memberships': memberships}
+
+        if options['engine'] == 'sql':
+            # The sql engine only does full runs and keeps no state, seed it for the incremental run
+            result['full'] = self._run_sync(directory, engine='sql')
+            self._run_sync(directory, incremental=True, state_file=state_file, full_interval=0)
+        else:
+            result['full'] = self._run_sync(directory, incremental=True, state_file=state_file, full_interval=0)
+
+        # Newer than anything the full run saw, so only these groups are picked up
+        changed_at = generalized_time(time.time() + 1)
+        for groupname in generator.sample(groupnames, min(options['changed_groups'], len(groupnames))):
+            members = generator.sample(usernames, min(options['group_size'], len(usernames)))
+            directory.modify('cn=%s,ou=groups,%s' % (groupname, LDAP_BASE_SEARCH), changed_at, memberUid=members)
+        result['incremental'] = self._run_sync(directory, incremental=True, state_file=state_file, full_interval=24)
+        return result
+
+    def _seed_rt(self, directory, usernames, groupnames, overlap, generator):
+        """Creates the RT users, groups and a share of the memberships
+
+        :returns the number of memberships in LDAP"""
+        RtUser.objects.create(name='root', id=USER_ID_DEFAULT)
+        for offset in range(0, len(usernames), DEFAULT_BATCH_SIZE):
+            names = usernames[offset:offset + DEFAULT_BATCH_SIZE]
+            ids = RtPrincipal.objects.create_principals(PRINCIPAL_USER, len(names))
+            RtUser.objects.bulk_create([RtUser(id=user_id, name=name) for user_id, name in zip(ids, names)])
+        group_ids = RtGroup.objects.create_groups(groupnames, {})
+        user_ids = dict(RtUser.objects.values_list('name', 'id'))
+
+        memberships = 0
+        pairs = set()
+        for group in directory.search('(objectClass=posixGroup)', 'ou=groups,' + LDAP_BASE_SEARCH, ['cn', 'memberUid']):
+            if group['cn'][0] == ALL_USERS_GROUP:
+                continue
+            memberships += len(group['memberUid'])
+            pairs.update((group_ids[group['cn'][0]], user_ids[username])
+                         for username in group['memberUid'] if generator.random() < overlap)
+        # Stale memberships the sync has to remove
+        for i in range(min(100, len(usernames))):
+            pairs.add((group_ids[generator.choice(groupnames)], user_ids[generator.choice(usernames)]))
+
+        rows = [RtGroupMember(group_id=group_id, member_id=member_id) for group_id, member_id in sorted(pairs)]
+        for offset in range(0, len(rows), DEFAULT_BATCH_SIZE):
+            RtGroupMember.objects.bulk_create(rows[offset:offset + DEFAULT_BATCH_SIZE])
+        return memberships
+
+    def _run_sync(self, directory, **options):
+        command = sync_ldap_groups.Command()
+        command.ldap_impl = directory
+        defaults = dict((option.dest, option.default) for option in command.option_list if option.dest)
+        defaults.update(options)
+        defaults['verbosity'] = 0
+
+        start = time.time()
+        command.execute(ALL_USERS_GROUP, **defaults)
+        result = dict(command.stats.totals())
+        result['wall_time'] = time.time() - start
+        result['peak_memory_kib'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return result
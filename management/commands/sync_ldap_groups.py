@@ -14,40 +14,553 @@ Create missing LDAP groups that aren't RTGroups
 Process one user at the time and do:
 * Add groups that the user is associated with in LDAP and the user doesn't have.
 * Remove groups that the user isn't associated with anylonger in LDAP
+
+With --incremental only groups with a modifyTimestamp newer than the
+last run are reconciled. A full sync is still done every --full-interval
+hours to pick up groups deleted from LDAP.
+
+With --daemon the command keeps running after the first sync, watches
+ou=groups through a persistent search (or polls modifyTimestamp when
+the server doesn't support it) and applies changed groups within
+seconds, still doing a full sync every --full-interval hours. When
+LDAP fails it logs the error and reconnects after --poll-interval
+seconds.
+
+With --dry-run nothing is written to RT, the groups and memberships
+that would be created and removed are printed as JSON instead.
+
+With --engine=sql the LDAP memberships are streamed into a temporary
+table and reconciled by the database in two set based statements,
+instead of diffing every user in Python.
+
+With --provision-users the synced users missing in RT are created, and
+the real name and email address of existing ones updated, from LDAP.
+
+With --nested groupOfNames groups are synced too, with the members of
+every group nested in them, which takes a full sync on every run.
+
+With --resume the run saves what it fetched from LDAP and every
+committed batch to a checkpoint next to the state file. If the run
+fails, the next run with --resume continues from the last committed
+batch with the saved LDAP data instead of starting over.
+
+With --profile=<file> the run is profiled with cProfile, and a report
+of the slowest kinds of LDAP searches, SQL statements and Python
+functions is written to <file>, the raw profile to <file>.prof.
+
+With --ldap-cache-ttl=<seconds> repeated LDAP searches are answered
+from a cache, useful with --daemon where the synced groups are looked
+up again on every full sync. Changes seen by the daemon empty it.
+
+With --workers=N the users are split into N partitions by a hash of
+their names, and each partition is diffed and applied by a worker
+process of its own, with its own LDAP and database connections. LDAP
+is searched and missing groups are created once, before the workers
+start.
+
+With --target-latency and --max-rows-per-second the membership batches
+are sized and paced to commit within the latency and stay under the
+rate, see throttle.WriteThrottle, for syncs during business hours.
+
+A run holds a database advisory lock, so runs overlapping each other
+fail instead of writing the same changes twice. Workers hold one per
+partition.
 """
-from django.core.management import BaseCommand
+from __future__ import absolute_import
+
+from django.core.management import BaseCommand, CommandError
+from optparse import make_option
+from django.db import connections
+import cProfile
 import itertools
-from rt_ldap_sync.ldap import LdapController
-from rt_ldap_sync.models import RtGroup, RtUser, RtGroupMember, USER_DEFINED
+import json
+import logging
+import multiprocessing
+import signal
+import time
+import zlib
+
+import ldap
+
+from rt_ldap_sync.instrumentation import SyncStats, HotSpotReport, observe_queries, profiled
+from rt_ldap_sync.ldap import LdapController, SearchCache, DEFAULT_POOL_SIZE, DEFAULT_CACHE_SIZE, NESTED_GROUP_PROFILE
+from rt_ldap_sync.models import RtGroup, RtUser, RtGroupMember, DEFAULT_BATCH_SIZE, LockNotAvailable, advisory_lock
 from rt_ldap_sync.settings import LDAP_HOSTNAME, LDAP_PORT, LDAP_BASE_SEARCH, LDAP_PROTOCOL
+from rt_ldap_sync.state import SyncState, DEFAULT_STATE_FILE, DEFAULT_SNAPSHOT_MAX_AGE
+from rt_ldap_sync.throttle import WriteThrottle
+from rt_ldap_sync.watch import GroupChangeCoalescer, make_group_watcher
+
+logger = logging.getLogger('rt_ldap_sync')
+
+# Held by every run writing to RT, see advisory_lock
+RUN_LOCK = 'rt_ldap_sync'
+
+# What the worker processes of a --workers run need, inherited when the pool forks
+_worker_context = None
+
+# The parent's database connections, kept referenced in a worker
+_inherited_connections = []
+
+
+def partition_of(username, partitions):
+    """The partition of a user, the same in every process and run
+
+    :username unicode, or UTF-8 str like the uids taken from member DNs"""
+    if isinstance(username, unicode):
+        username = username.encode('utf-8')
+    return (zlib.crc32(username) & 0xffffffff) % partitions
+
+
+def _init_worker():
+    # The parent's database connections were inherited. Closing them, or
+    # letting them be freed which MySQLdb and psycopg2 take as closing,
+    # would end the parent's session and its advisory lock. They are kept
+    # until the worker exits, which multiprocessing does without freeing
+    for connection in connections.all():
+        if connection.connection is not None:
+            _inherited_connections.append(connection.connection)
+        connection.connection = None
+
+
+def _run_worker(partition):
+    usernames, membership_index, group_ids, options = _worker_context
+    return Command()._sync_partition(partition, usernames[partition], membership_index, group_ids, options)
 
 class Command(BaseCommand):
     args = '<ldap_group> <ldap_group ...>'
     help = 'Synchronizes the LDAP groups and membership to RequestTracker'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', type='int', dest='batch_size',
+                    default=DEFAULT_BATCH_SIZE,
+                    help='Membership changes written per transaction'),
+        make_option('--incremental', action='store_true', dest='incremental', default=False,
+                    help='Only reconcile LDAP groups changed since the last run'),
+        make_option('--state-file', action='store', dest='state_file', default=DEFAULT_STATE_FILE,
+                    help='File keeping the LDAP high-water mark between runs'),
+        make_option('--full-interval', action='store', type='float', dest='full_interval', default=24,
+                    help='Hours between full syncs when running incrementally'),
+        make_option('--ldap-connections', action='store', type='int', dest='ldap_connections',
+                    default=DEFAULT_POOL_SIZE,
+                    help='LDAP connections used for concurrent searches'),
+        make_option('--dry-run', '--plan', action='store_true', dest='dry_run', default=False,
+                    help='Print the planned changes as JSON without writing to RT'),
+        make_option('--stats-json', action='store', dest='stats_json', default=None,
+                    help='Write per-phase timings and counters to this JSON file'),
+        make_option('--prometheus-textfile', action='store', dest='prometheus_textfile', default=None,
+                    help='Write per-phase timings and counters for the node_exporter textfile collector'),
+        make_option('--daemon', action='store_true', dest='daemon', default=False,
+                    help='Keep running and apply LDAP group changes as they happen'),
+        make_option('--poll-interval', action='store', type='float', dest='poll_interval', default=10,
+                    help='Seconds between polls for changed groups when persistent search is unavailable'),
+        make_option('--debounce', action='store', type='float', dest='debounce', default=2,
+                    help='Seconds without further changes before applying a batch in daemon mode'),
+        make_option('--max-delay', action='store', type='float', dest='max_delay', default=30,
+                    help='Longest a change waits to be applied in daemon mode'),
+        make_option('--engine', action='store', dest='engine', default='python',
+                    help='Where memberships are reconciled, python or sql (staging table)'),
+        make_option('--provision-users', action='store_true', dest='provision_users', default=False,
+                    help='Create missing RT users and update their real name and email from LDAP'),
+        make_option('--nested', action='store_true', dest='nested', default=False,
+                    help='Also sync groupOfNames groups, expanding groups nested in groups'),
+        make_option('--resume', action='store_true', dest='resume', default=False,
+                    help='Checkpoint the run, continuing the checkpoint of a failed run if there is one'),
+        make_option('--resume-max-age', action='store', type='float', dest='resume_max_age',
+                    default=DEFAULT_SNAPSHOT_MAX_AGE / 3600.0,
+                    help='Hours after which a checkpoint is too old to resume, its LDAP data being out of date'),
+        make_option('--profile', action='store', dest='profile', default=None,
+                    help='Profile the run, writing a hot spot report to this file and the raw profile to <file>.prof'),
+        make_option('--profile-top', action='store', type='int', dest='profile_top', default=20,
+                    help='Entries per section of the --profile report'),
+        make_option('--ldap-cache-ttl', action='store', type='float', dest='ldap_cache_ttl', default=0,
+                    help='Seconds LDAP search results are cached, 0 to not cache'),
+        make_option('--ldap-cache-size', action='store', type='int', dest='ldap_cache_size',
+                    default=DEFAULT_CACHE_SIZE,
+                    help='LDAP searches kept in the cache'),
+        make_option('--workers', action='store', type='int', dest='workers', default=1,
+                    help='Processes diffing and applying the users, split by a hash of their names'),
+        make_option('--target-latency', action='store', type='float', dest='target_latency', default=0,
+                    help='Seconds a membership batch may take to commit, adapting the batch size, 0 for no limit'),
+        make_option('--max-rows-per-second', action='store', type='float', dest='max_rows_per_second', default=0,
+                    help='Membership rows written per second, shared by the workers, 0 for no limit'),
+    )
+
+    # LDAP implementation handed to LdapController, simpleldap if None
+    ldap_impl = None
+    # WriteThrottle pacing the membership batches, None to write at full speed
+    throttle = None
 
     def handle(self, *args, **options):
-        self.ldap = LdapController()
+        if options['engine'] not in ('python', 'sql'):
+            raise CommandError('--engine must be python or sql')
+        if options['engine'] == 'sql' and (options['dry_run'] or options['daemon'] or options['incremental']):
+            raise CommandError('--engine=sql only does full syncs, without --dry-run, --daemon or --incremental')
+        if options['nested'] and (options['daemon'] or options['incremental']):
+            raise CommandError('--nested only does full syncs, without --daemon or --incremental')
+        if options['resume'] and (options['engine'] == 'sql' or options['dry_run'] or options['daemon']):
+            raise CommandError('--resume only checkpoints --engine=python runs, without --dry-run or --daemon')
+        if options['engine'] == 'sql' and (options['target_latency'] or options['max_rows_per_second']):
+            raise CommandError('--engine=sql reconciles in one transaction, which can not be throttled')
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1')
+        if options['workers'] > 1 and (options['engine'] == 'sql' or options['dry_run'] or options['daemon']
+                                       or options['incremental'] or options['resume']):
+            raise CommandError('--workers only does full --engine=python syncs, without --dry-run, --daemon, '
+                               '--incremental or --resume')
+
+        self.stats = SyncStats()
+        self.throttle = self._make_throttle(options)
+        cache = SearchCache(options['ldap_cache_ttl'], options['ldap_cache_size']) if options['ldap_cache_ttl'] > 0 else None
+        self.ldap = LdapController(self.ldap_impl, pool_size=options['ldap_connections'],
+                                   nested_group_profile=NESTED_GROUP_PROFILE if options['nested'] else None,
+                                   cache=cache)
+        self.ldap.search_listeners.append(self.stats.on_search)
+        query_observers = [self.stats.on_query]
+        profiler = None
+        if options['profile']:
+            # Searches on pooled connections run in other threads, cProfile
+            # only sees them as waiting, the hot spot report has their latency
+            profiler, hot_spots = cProfile.Profile(), HotSpotReport()
+            self.ldap.search_listeners.append(hot_spots.on_search)
+            query_observers.append(hot_spots.on_query)
         self.ldap.connect(LDAP_HOSTNAME, LDAP_PORT, LDAP_BASE_SEARCH, LDAP_PROTOCOL)
-        ldap_groups = list(itertools.chain.from_iterable([group['cn'] for group in self.ldap.get_groups_all()]))
 
-        groups_to_create = RtGroup.objects.find_groups_not_listed(ldap_groups)
-        if groups_to_create:
-            for group in groups_to_create:
-                RtGroup.objects.create(name=group, type=USER_DEFINED)
+        state = SyncState.load(options['state_file'])
+        try:
+            with observe_queries(connections[RtGroupMember.objects.db], *query_observers):
+                with profiled(profiler):
+                    if options['dry_run']:
+                        self._sync(args, options, state)
+                    else:
+                        with advisory_lock(RUN_LOCK, RtGroupMember.objects.db):
+                            if options['daemon']:
+                                self._daemon(args, options, state)
+                            elif options['engine'] == 'sql':
+                                self._sync_sql(args, options)
+                                self._clear_checkpoint(state)
+                            elif options['workers'] > 1:
+                                self._sync_workers(args, options)
+                                self._clear_checkpoint(state)
+                            else:
+                                self._sync(args, options, state)
+        except LockNotAvailable:
+            raise CommandError('Another sync is already running')
+        finally:
+            self.ldap.close()
+            if profiler is not None:
+                hot_spots.write(options['profile'], profiler, options['profile_top'])
+
+        self.stats.log_summary()
+        if self.throttle is not None and options['workers'] == 1:
+            logger.info('Writes throttled: last batch size %d, paused %.1fs', self.throttle.batch_size, self.throttle.paused)
+        if cache is not None:
+            logger.info('LDAP search cache: %(hits)d hits, %(misses)d misses, %(evictions)d evictions', cache.stats())
+        if options['stats_json']:
+            self.stats.write_json(options['stats_json'])
+        if options['prometheus_textfile']:
+            self.stats.write_prometheus(options['prometheus_textfile'])
+
+    def _sync(self, args, options, state):
+        dry_run = options['dry_run']
+        keep_state = options['incremental'] or options['daemon']
+        incremental = options['incremental'] and not state.is_full_run_due(options['full_interval'])
+
+        snapshot = state.load_snapshot(options['resume_max_age'] * 3600) if options['resume'] else None
+        if snapshot:
+            logger.info('Resuming the sync checkpointed at member id %s', state.checkpoint['applied_through'])
+            incremental = snapshot['incremental']
+            ldap_groups, self._scope = snapshot['groups'], set(snapshot['scope'])
+            high_water_mark = snapshot['high_water_mark']
+            if incremental:
+                group_members = snapshot['memberships']
+            else:
+                membership_index = snapshot['memberships']
+        else:
+            with self.stats.phase('ldap_fetch'):
+                high_water_mark = None
+                if incremental:
+                    ldap_group_entries = self.ldap.get_groups_changed_since(state.high_water_mark)
+                    high_water_mark = self._high_water_mark(ldap_group_entries)
+                    group_members = dict((name, set(group.get('memberUid', [])))
+                                         for group in ldap_group_entries for name in group['cn'])
+                    if set(args) & set(group_members):
+                        # The set of synced users changed, only a full run catches every group they are in
+                        logger.info('Synced groups changed, running a full sync')
+                        incremental = False
+                if not incremental:
+                    # Outstanding while the members are searched, see LdapController.start_search
+                    pending_groups = self.ldap.start_groups_all()
+
+                self._scope = self._scope_usernames(args)
+
+                if not incremental:
+                    # One search for every group's members instead of one search per user
+                    membership_index = self.ldap.get_membership_matrix()
+                    ldap_group_entries = pending_groups.result()
+                    high_water_mark = max(high_water_mark, self._high_water_mark(ldap_group_entries))
+                ldap_groups = self._ldap_group_names(ldap_group_entries)
+
+            if options['resume']:
+                if not incremental:
+                    membership_index = dict((username, sorted(membership_index.groups_of(username)))
+                                            for username in self._scope if username in membership_index.users)
+                state.start_checkpoint({
+                    'incremental': incremental,
+                    'groups': ldap_groups,
+                    'scope': sorted(self._scope),
+                    'high_water_mark': high_water_mark,
+                    'memberships': dict((name, sorted(members)) for name, members in group_members.iteritems())
+                                   if incremental else membership_index,
+                })
+
+        if options['provision_users'] and not (snapshot and state.checkpoint['provisioned']):
+            provisioned = self._provision_users(options['batch_size'], dry_run)
+            if options['resume']:
+                state.update_checkpoint(provisioned=True)
+
+        with self.stats.phase('rt_load'):
+            group_ids = RtGroup.objects.group_ids()
+            groups_to_create = RtGroup.objects.find_groups_not_listed(ldap_groups, group_ids)
+            rt_users = self._rt_users(self._scope, options['batch_size'])
+            if snapshot and state.checkpoint['applied_through'] is not None:
+                # Users up to the checkpoint were applied by the failed run
+                rt_users = [user for user in rt_users if user.id > state.checkpoint['applied_through']]
+
+        with self.stats.phase('diff'):
+            if incremental:
+                changes = RtGroupMember.objects.diff_group_memberships(rt_users, group_members)
+            else:
+                changes = RtGroupMember.objects.diff_memberships(rt_users, membership_index)
+
+        if dry_run:
+            plan = self._plan(groups_to_create, changes, incremental)
+            if options['provision_users']:
+                plan['users_to_create'], plan['users_to_update'] = provisioned
+            self.stdout.write(json.dumps(plan, indent=2, sort_keys=True) + '\n')
+        else:
+            on_batch = (lambda member_id: state.update_checkpoint(applied_through=member_id)) if options['resume'] else None
+            self._apply(groups_to_create, group_ids, changes, options['batch_size'], on_batch)
+
+            # Also a checkpoint left by an earlier failed run, resuming it would undo this run
+            checkpointed = state.clear_checkpoint()
+            if keep_state:
+                state.high_water_mark = high_water_mark
+                if not incremental:
+                    state.mark_full_run()
+            if keep_state or checkpointed:
+                state.save()
+
+    def _clear_checkpoint(self, state):
+        """Drops the checkpoint of an earlier failed run, stale after a successful one"""
+        if state.clear_checkpoint():
+            state.save()
+
+    def _high_water_mark(self, ldap_group_entries):
+        """Newest modifyTimestamp of the groups, None if they have none"""
+        return max([max(group.get('modifyTimestamp', [None])) for group in ldap_group_entries] or [None])
+
+    def _sync_sql(self, args, options):
+        """Full sync reconciled inside the database, see RtGroupMemberManager.reconcile_from_staging"""
+        with self.stats.phase('ldap_fetch'):
+            ldap_groups = self._ldap_group_names(self.ldap.iter_groups_all())
+            self._scope = self._scope_usernames(args)
+
+        if options['provision_users']:
+            self._provision_users(options['batch_size'])
+
+        with self.stats.phase('rt_load'):
+            group_ids = RtGroup.objects.group_ids()
+            groups_to_create = RtGroup.objects.find_groups_not_listed(ldap_groups, group_ids)
+
+        with self.stats.phase('apply'):
+            RtGroup.objects.create_groups(groups_to_create, group_ids, options['batch_size'], self.throttle)
+            inserted, deleted = RtGroupMember.objects.reconcile_from_staging(
+                self.ldap.iter_membership_pairs(), self._scope, options['batch_size'])
+            self.stats.count('rows_inserted', len(groups_to_create) + inserted)
+            self.stats.count('rows_deleted', deleted)
+
+    def _make_throttle(self, options, workers=1):
+        if not (options['target_latency'] or options['max_rows_per_second']):
+            return None
+        return WriteThrottle(options['target_latency'] or None, (options['max_rows_per_second'] / workers) or None,
+                             options['batch_size'])
+
+    def _sync_workers(self, args, options):
+        """Full sync with the users diffed and applied by worker processes, see _sync_partition"""
+        global _worker_context
+        workers = options['workers']
+
+        with self.stats.phase('ldap_fetch'):
+            ldap_groups = self._ldap_group_names(self.ldap.get_groups_all())
+            self._scope = self._scope_usernames(args)
+            membership_index = self.ldap.get_membership_matrix()
+
+        if options['provision_users']:
+            # Once for every worker, each would search every user
+            self._provision_users(options['batch_size'])
+
+        with self.stats.phase('rt_load'):
+            group_ids = RtGroup.objects.group_ids()
+            groups_to_create = RtGroup.objects.find_groups_not_listed(ldap_groups, group_ids)
+        with self.stats.phase('apply'):
+            # Before forking, so every worker sees every group
+            RtGroup.objects.create_groups(groups_to_create, group_ids, options['batch_size'], self.throttle)
+            self.stats.count('rows_inserted', len(groups_to_create))
+
+        usernames = [[] for partition in range(workers)]
+        for username in self._scope:
+            usernames[partition_of(username, workers)].append(username)
+
+        _worker_context = (usernames, membership_index, group_ids, options)
+        pool = multiprocessing.Pool(workers, _init_worker)
+        try:
+            results = pool.map(_run_worker, range(workers))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _worker_context = None
+
+        for phases in results:
+            self.stats.merge(phases)
+        logger.info('%d workers synced %d users', workers, len(self._scope))
+
+    def _sync_partition(self, partition, usernames, membership_index, group_ids, options):
+        """Diffs and applies the users of one partition, in a worker process
+
+        :returns the worker's SyncStats phases"""
+        self.stats = SyncStats()
+        self.throttle = self._make_throttle(options, options['workers'])
+        self._scope = set(usernames)
+        self.ldap = LdapController(self.ldap_impl, pool_size=options['ldap_connections'])
+        self.ldap.search_listeners.append(self.stats.on_search)
+        self.ldap.connect(LDAP_HOSTNAME, LDAP_PORT, LDAP_BASE_SEARCH, LDAP_PROTOCOL)
+        try:
+            with advisory_lock('%s partition %d/%d' % (RUN_LOCK, partition, options['workers']), RtGroupMember.objects.db):
+                with observe_queries(connections[RtGroupMember.objects.db], self.stats.on_query):
+                    with self.stats.phase('rt_load'):
+                        rt_users = self._rt_users(self._scope, options['batch_size'])
+                    with self.stats.phase('diff'):
+                        # A partition's users only have a part of the memberships
+                        changes = RtGroupMember.objects.diff_memberships(rt_users, membership_index, load_all=False)
+                    self._apply([], group_ids, changes, options['batch_size'])
+        finally:
+            self.ldap.close()
+        return self.stats.phases
+
+    def _provision_users(self, batch_size, dry_run=False):
+        """Creates and updates the RT users of the synced LDAP users
+
+        :returns tuple of (users created, users updated)"""
+        with self.stats.phase('provision'):
+            created, updated = RtUser.objects.provision(self.ldap.iter_user_records(self._scope), batch_size, dry_run)
+            if not dry_run:
+                self.stats.count('rows_inserted', created)
+                self.stats.count('rows_updated', updated)
+        if created or updated:
+            logger.info('%s %d RT users, updated %d', 'Would create' if dry_run else 'Created', created, updated)
+        return created, updated
+
+    def _ldap_group_names(self, ldap_group_entries):
+        """Names of the LDAP groups to create in RT, nested groups included with --nested"""
+        if self.ldap.nested_group_profile:
+            return self.ldap.get_group_graph().names()
+        return list(itertools.chain.from_iterable(group['cn'] for group in ldap_group_entries))
+
+    def _scope_usernames(self, args):
+        """Members of the <ldap_group> arguments, the users that get synced"""
+        return set(itertools.chain.from_iterable(self.ldap.get_members_by_group(args).itervalues()))
+
+    def _rt_users(self, usernames, batch_size):
+        # (id, name) rows only, chunked as a single IN (...) with every username breaks on SQLite
+        return list(RtUser.objects.iter_rows(usernames, batch_size))
+
+    def _apply(self, groups_to_create, group_ids, changes, batch_size, on_batch=None):
+        with self.stats.phase('apply'):
+            RtGroup.objects.create_groups(groups_to_create, group_ids, batch_size, self.throttle)
+            inserted, deleted = RtGroupMember.objects.apply_changes(changes, group_ids, batch_size, on_batch, self.throttle)
+            self.stats.count('rows_inserted', len(groups_to_create) + inserted)
+            self.stats.count('rows_deleted', deleted)
+        return inserted, deleted
+
+    def _daemon(self, args, options, state):
+        """Keeps RT in sync with LDAP until stopped with SIGTERM or SIGINT"""
+        self._stopping = False
+        signal.signal(signal.SIGTERM, self._stop)
+
+        options = dict(options, dry_run=False)
+        self._sync(args, options, state)
+        watcher = make_group_watcher(self.ldap, state.high_water_mark, options['poll_interval'])
+        coalescer = GroupChangeCoalescer(options['debounce'], options['max_delay'])
+        logger.info('Watching LDAP groups for changes with %s', watcher.__class__.__name__)
+
+        try:
+            while not self._stopping:
+                try:
+                    if not self.ldap.is_connected():
+                        self.ldap.connect(LDAP_HOSTNAME, LDAP_PORT, LDAP_BASE_SEARCH, LDAP_PROTOCOL)
+                    self._daemon_cycle(args, options, state, watcher, coalescer)
+                except ldap.LDAPError, e:
+                    logger.warning('LDAP failed, reconnecting in %ss: %s', options['poll_interval'], e)
+                    self.ldap.close()
+                    time.sleep(options['poll_interval'])
+        except KeyboardInterrupt:
+            pass
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+    def _daemon_cycle(self, args, options, state, watcher, coalescer):
+        """Waits for LDAP changes and applies them once they settle"""
+        for entry in watcher.changes(coalescer.wait_time(options['poll_interval'])):
+            coalescer.add(entry)
+
+        if coalescer.ready():
+            changed = coalescer.pop()
+            self.ldap.invalidate_cache()
+            group_members = dict((name, set(entry.get('memberUid', []))) for name, entry in changed.iteritems())
+            if set(args) & set(group_members):
+                # The set of synced users changed, only a full run catches every group they are in
+                logger.info('Synced groups changed, running a full sync')
+                self._sync(args, dict(options, incremental=False), state)
+            else:
+                inserted, deleted = self._apply_group_changes(group_members, options['batch_size'])
+                logger.info('Applied changes to %d groups: %d memberships added, %d removed',
+                            len(group_members), inserted, deleted)
+                for entry in changed.itervalues():
+                    state.high_water_mark = max(entry.get('modifyTimestamp', [None]))
+                state.save()
+
+        if state.is_full_run_due(options['full_interval']):
+            self._sync(args, dict(options, incremental=False), state)
 
-        tmp_set_for_unique_usernames = set()
-        for ldap_groupname in args:
-            tmp_set_for_unique_usernames.update(self.ldap.get_groups_member(ldap_groupname))
-        ldap_username_list = list(tmp_set_for_unique_usernames)
+    def _apply_group_changes(self, group_members, batch_size):
+        """Reconciles only the given groups for the synced users
 
-        rt_users = RtUser.objects.filter(name__in=ldap_username_list)
-        for user in rt_users:
-            user_groups = self._get_groups_from_ldap_user(user)
+        :group_members dict of group name -> set of LDAP member usernames"""
+        with self.stats.phase('rt_load'):
+            group_ids = RtGroup.objects.group_ids()
+            groups_to_create = RtGroup.objects.find_groups_not_listed(
+                [name for name, members in group_members.iteritems() if members], group_ids)
+            affected = set(itertools.chain.from_iterable(group_members.itervalues()))
+            affected.update(RtGroupMember.objects.member_names(group_members.keys()))
+            rt_users = self._rt_users(affected & self._scope, batch_size)
 
-            for group in RtGroupMember.objects.extra_ldap_groups(user, user_groups):
-                RtGroupMember.objects.create(group=RtGroup.objects.get(name=group), member=user)
-            RtGroupMember.objects.filter(group__in=RtGroupMember.objects.extra_rt_groups(user, user_groups), member=user).delete()
+        with self.stats.phase('diff'):
+            changes = RtGroupMember.objects.diff_group_memberships(rt_users, group_members)
 
+        return self._apply(groups_to_create, group_ids, changes, batch_size)
 
-    def _get_groups_from_ldap_user(self, ldap_username):
-        return self.ldap.get_groups(ldap_username)
+    def _plan(self, groups_to_create, changes, incremental):
+        """The change set of a dry run, as a JSON serializable dict"""
+        groups = changes.per_group()
+        return {
+            'mode': 'incremental' if incremental else 'full',
+            'groups_to_create': groups_to_create,
+            'memberships_to_add': len(changes.additions),
+            'memberships_to_remove': len(changes.removals),
+            'groups': dict((name, {'add': add, 'remove': remove})
+                           for name, (add, remove) in groups.iteritems()),
+            'timings': dict((name, stats['wall_time']) for name, stats in self.stats.phases.iteritems()),
+        }
@@ -0,0 +1,137 @@
+"""Compact user x group membership matrix
+
+A dict of username -> set of group names costs a few hundred bytes per
+user. MembershipMatrix interns user and group names to integer ids and
+keeps the matrix in compressed sparse row form, every user's sorted
+group ids one after the other in an array('I'), so a membership costs
+4 bytes (8 more when a value such as the groupmembers row id is kept).
+
+Matrices sharing an Interner for groups use the same group ids, so the
+LDAP and RT side can be compared row by row without touching names.
+"""
+from array import array
+
+
+class Interner(object):
+    """Maps names to dense integer ids and back"""
+    def __init__(self):
+        self._ids = {}
+        self.names = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._ids
+
+    def id(self, name):
+        """The id of name, assigned the first time it's seen"""
+        try:
+            return self._ids[name]
+        except KeyError:
+            self._ids[name] = len(self.names)
+            self.names.append(name)
+            return self._ids[name]
+
+    def get(self, name, default=None):
+        return self._ids.get(name, default)
+
+
+class MembershipMatrix(object):
+    """Memberships added with add(), then frozen for lookups with row()
+
+    :groups Interner shared with the matrices this one is compared with
+    :values keep a value per membership, see add()"""
+    def __init__(self, groups=None, values=False):
+        self.groups = groups if groups is not None else Interner()
+        self.users = Interner()
+        self._user_ids = array('I')
+        self._group_ids = array('I')
+        self._values = array('l') if values else None
+        self._offsets = None
+
+    def __len__(self):
+        return len(self._group_ids)
+
+    @classmethod
+    def from_pairs(cls, pairs, groups=None):
+        """Builds a frozen matrix from (user, group name) pairs"""
+        matrix = cls(groups)
+        for user, groupname in pairs:
+            matrix.add(user, groupname)
+        return matrix.freeze()
+
+    @classmethod
+    def from_index(cls, index, groups=None):
+        """Builds a frozen matrix from a dict of user -> group names"""
+        return cls.from_pairs(((user, groupname) for user, groupnames in index.iteritems()
+                               for groupname in groupnames), groups)
+
+    def add(self, user, groupname, value=0):
+        if self._offsets is not None:
+            raise ValueError('Matrix is frozen')
+        self._user_ids.append(self.users.id(user))
+        self._group_ids.append(self.groups.id(groupname))
+        if self._values is not None:
+            self._values.append(value)
+
+    def freeze(self):
+        """Sorts the memberships into rows, a counting sort over user ids
+
+        :returns self"""
+        counts = array('I', [0]) * (len(self.users) + 1)
+        for user_id in self._user_ids:
+            counts[user_id + 1] += 1
+        for i in xrange(1, len(counts)):
+            counts[i] += counts[i - 1]
+        offsets = array('I', counts)
+
+        group_ids = array('I', [0]) * len(self._group_ids)
+        values = array('l', [0]) * len(self._group_ids) if self._values is not None else None
+        for i, user_id in enumerate(self._user_ids):
+            position = counts[user_id]
+            counts[user_id] += 1
+            group_ids[position] = self._group_ids[i]
+            if values is not None:
+                values[position] = self._values[i]
+
+        for user_id in xrange(len(self.users)):
+            start, end = offsets[user_id], offsets[user_id + 1]
+            if end - start < 2:
+                continue
+            if values is None:
+                group_ids[start:end] = array('I', sorted(group_ids[start:end]))
+            else:
+                row = sorted(zip(group_ids[start:end], values[start:end]))
+                group_ids[start:end] = array('I', [group_id for group_id, value in row])
+                values[start:end] = array('l', [value for group_id, value in row])
+
+        self._user_ids = None
+        self._group_ids, self._values, self._offsets = group_ids, values, offsets
+        return self
+
+    def row(self, user):
+        """The sorted group ids of a user, and their values if kept
+
+        :returns tuple of (array of group ids, array of values or None)"""
+        user_id = self.users.get(user)
+        if user_id is None:
+            return array('I'), array('l') if self._values is not None else None
+        start, end = self._offsets[user_id], self._offsets[user_id + 1]
+        return self._group_ids[start:end], self._values[start:end] if self._values is not None else None
+
+    def groups_of(self, user):
+        """The group names of a user, as a set"""
+        return set(self.groups.names[group_id] for group_id in self.row(user)[0])
+
+
+def sorted_difference(a, b):
+    """Positions in sorted a of the ids that aren't in sorted b"""
+    positions = []
+    j, size_b = 0, len(b)
+    for i, value in enumerate(a):
+        while j < size_b and b[j] < value:
+            j += 1
+        if j == size_b or b[j] != value:
+            positions.append(i)
+    return positions
@@ -3,13 +3,180 @@
 Models that represent database tables in RequestTracker
 """
 
-from django.db import models
-from django.db.models import Q
+import contextlib
+import errno
+import fcntl
+import logging
+import os
+import tempfile
+import time
+import zlib
+from collections import namedtuple
+
+from django.db import DatabaseError, connections, models, transaction
+from django.db.models import F, Q
+from django.db.models.sql import DeleteQuery
+from django.utils import timezone
+
+from rt_ldap_sync.matrix import MembershipMatrix, sorted_difference
+
+logger = logging.getLogger('rt_ldap_sync')
 
 
 USER_ID_DEFAULT = 0
 GROUP_ID_DEFAULT = 0
 
+# principals.principaltype of users and groups
+PRINCIPAL_USER = 'User'
+PRINCIPAL_GROUP = 'Group'
+
+# Membership rows written per transaction when applying changes
+DEFAULT_BATCH_SIZE = 100
+
+# Temporary tables used by RtGroupMemberManager.reconcile_from_staging
+STAGING_TABLE = 'rt_ldap_sync_staging'
+SCOPE_TABLE = 'rt_ldap_sync_scope'
+
+# What the sync needs of an RT user, without the ~35 columns of RtUser
+RtUserRow = namedtuple('RtUserRow', 'id name')
+
+# RtUser fields kept up to date from LDAP by RtUserManager.provision
+PROVISIONED_FIELDS = ('realname', 'emailaddress')
+
+
+class LockNotAvailable(Exception):
+    """Raised by advisory_lock when the lock is held by someone else"""
+
+
+@contextlib.contextmanager
+def advisory_lock(name, using='default'):
+    """Holds a named lock shared by everyone using the RT database
+
+    PostgreSQL and MySQL advisory locks, held by the connection, so they
+    work across hosts. Other databases get a lock file, SQLite only
+    works on one host anyway.
+
+    :raises LockNotAvailable without waiting if the lock is held"""
+    connection = connections[using]
+    if connection.vendor in ('postgresql', 'mysql'):
+        cursor = connection.cursor()
+        if connection.vendor == 'postgresql':
+            key = zlib.crc32(name) & 0x7fffffff
+            cursor.execute('SELECT pg_try_advisory_lock(%s)', [key])
+            release_sql, release_params = 'SELECT pg_advisory_unlock(%s)', [key]
+        else:
+            cursor.execute('SELECT GET_LOCK(%s, 0)', [name])
+            release_sql, release_params = 'SELECT RELEASE_LOCK(%s)', [name]
+        if not cursor.fetchone()[0]:
+            raise LockNotAvailable(name)
+        try:
+            yield
+        finally:
+            _release_lock(connection, release_sql, release_params)
+        return
+
+    key = zlib.crc32('%s %s' % (connection.settings_dict['NAME'], name)) & 0xffffffff
+    with open(os.path.join(tempfile.gettempdir(), 'rt_ldap_sync-%08x.lock' % key), 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                raise LockNotAvailable(name)
+            raise
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _release_lock(connection, release_sql, release_params):
+    """Releases an advisory lock without hiding the exception that ended the block"""
+    try:
+        connection.cursor().execute(release_sql, release_params)
+    except DatabaseError:
+        try:
+            # PostgreSQL refuses every statement after a failed one until rolled back
+            transaction.rollback_unless_managed(using=connection.alias)
+            connection.cursor().execute(release_sql, release_params)
+        except Exception, e:
+            # The driver's own errors too, a lost connection took the lock with it
+            logger.warning('Could not release advisory lock: %s', e)
+
+
+class RtUserManager(models.Manager):
+    def create(self, **kwargs):
+        """Creates a user with its principal, unless given an id"""
+        if 'id' not in kwargs:
+            kwargs['id'] = RtPrincipal.objects.create_principals(PRINCIPAL_USER, 1)[0]
+        return super(RtUserManager, self).create(**kwargs)
+
+    def iter_rows(self, usernames, batch_size=DEFAULT_BATCH_SIZE):
+        """Streams the RT users with the given names as RtUserRow tuples
+
+        Only id and name are selected, in IN (...) batches of batch_size
+        names, and rows aren't cached by the queryset.
+
+        :usernames iterable of usernames, duplicates are ignored"""
+        usernames = sorted(set(usernames))
+        for offset in range(0, len(usernames), batch_size):
+            queryset = self.filter(name__in=usernames[offset:offset + batch_size]).values_list('id', 'name')
+            for row in queryset.iterator():
+                yield RtUserRow._make(row)
+
+    def provision(self, ldap_users, batch_size=DEFAULT_BATCH_SIZE, dry_run=False):
+        """Creates the missing RT users and updates changed PROVISIONED_FIELDS
+
+        New users are bulk inserted batch_size at a time, with their
+        principals. Changed users
+        are updated with one executemany per batch and combination of
+        changed fields, so unchanged columns aren't written.
+
+        :ldap_users iterable of (name, realname, emailaddress)
+        :dry_run only count what would be written
+        :returns tuple of (users created, users updated)"""
+        fields = [self.model._meta.get_field(field_name) for field_name in PROVISIONED_FIELDS]
+        ldap_users = dict((user[0], tuple(value[:field.max_length] for field, value in zip(fields, user[1:])))
+                          for user in ldap_users)
+        usernames = sorted(ldap_users)
+
+        updates = {}
+        existing = set()
+        for offset in range(0, len(usernames), batch_size):
+            queryset = self.filter(name__in=usernames[offset:offset + batch_size]).values_list('id', 'name', *PROVISIONED_FIELDS)
+            for row in queryset.iterator():
+                user_id, name, old_values = row[0], row[1], row[2:]
+                existing.add(name)
+                changed = [(field, new) for field, old, new in zip(fields, old_values, ldap_users[name]) if old != new]
+                if changed:
+                    updates.setdefault(tuple(field for field, new in changed), []).append(
+                        [new for field, new in changed] + [user_id])
+        missing = [username for username in usernames if username not in existing]
+        if dry_run:
+            return len(missing), sum(len(rows) for rows in updates.itervalues())
+
+        for offset in range(0, len(missing), batch_size):
+            with transaction.commit_on_success(using=self.db):
+                batch = missing[offset:offset + batch_size]
+                ids = RtPrincipal.objects.create_principals(PRINCIPAL_USER, len(batch))
+                self.bulk_create([self.model(id=new_id, name=new_name, **dict(zip(PROVISIONED_FIELDS, ldap_users[new_name])))
+                                  for new_id, new_name in zip(ids, batch)])
+
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        last_updated = connection.ops.value_to_db_datetime(timezone.now())
+        updated = 0
+        for changed, rows in updates.iteritems():
+            sql = 'UPDATE %s SET %s, %s = %%s WHERE %s = %%s' % (
+                qn(self.model._meta.db_table), ', '.join('%s = %%s' % qn(field.column) for field in changed),
+                qn(self.model._meta.get_field('last_updated').column), qn(self.model._meta.pk.column))
+            for offset in range(0, len(rows), batch_size):
+                with transaction.commit_on_success(using=self.db):
+                    connection.cursor().executemany(sql, [row[:-1] + [last_updated, row[-1]]
+                                                          for row in rows[offset:offset + batch_size]])
+            updated += len(rows)
+        return len(missing), updated
+
+
 class RtUser(models.Model):
     """Represents the 'users' table in RT"""
     id = models.AutoField(primary_key=True)
@@ -48,28 +215,103 @@ class RtUser(models.Model):
     last_updated_by = models.ForeignKey('self', default=USER_ID_DEFAULT, null=False, db_column='lastupdatedby', related_name='user_last_updated_by_set')
     last_updated = models.DateTimeField(auto_now=True, db_column='lastupdated')
 
+    objects = RtUserManager()
+
     class Meta:
         db_table = 'users'
 
 
 
+class RtPrincipalManager(models.Manager):
+    def create_principals(self, principal_type, count):
+        """Creates count principals in one bulk insert
+
+        Each row is inserted with a unique negative objectid to find its
+        id again, objectid is then set to the id as RT does. Runs in the
+        caller's transaction, or in its own outside one, so the markers
+        are never committed.
+
+        :returns list of the new principal ids"""
+        if not transaction.is_managed(using=self.db):
+            with transaction.commit_on_success(using=self.db):
+                return self.create_principals(principal_type, count)
+        markers = range(-1, -count - 1, -1)
+        self.bulk_create([self.model(principal_type=principal_type, object_id=marker) for marker in markers])
+        ids = dict(self.filter(principal_type=principal_type, object_id__in=markers).values_list('object_id', 'id'))
+        self.filter(id__in=ids.values()).update(object_id=F('id'))
+        return [ids[marker] for marker in markers]
+
+
+class RtPrincipal(models.Model):
+    """Represents the 'principals' table in RT, users and groups share their id with a principal"""
+    id = models.AutoField(primary_key=True)
+    principal_type = models.CharField(max_length=16, db_column='principaltype')
+    object_id = models.IntegerField(null=True, db_column='objectid')
+    disabled = models.IntegerField(default=0)
+
+    objects = RtPrincipalManager()
+
+    class Meta:
+        db_table = 'principals'
+
+
 USER_DEFINED = 'UserDefined'
 RT_QUEUE_ROLE = 'RT::Queue-Role'
 
 class RTGroupManager(models.Manager):
+    def create(self, **kwargs):
+        """Creates a group with its principal, unless given an id"""
+        if 'id' not in kwargs:
+            kwargs['id'] = RtPrincipal.objects.create_principals(PRINCIPAL_GROUP, 1)[0]
+        return super(RTGroupManager, self).create(**kwargs)
+
     def has_group(self, name):
         return self.filter(name=name, domain=USER_DEFINED)
 
-    def find_groups_not_listed(self, groups):
+    def group_ids(self):
+        """Returns a dictionary of name -> id for every UserDefined group"""
+        return dict(self.filter(domain=USER_DEFINED).values_list('name', 'id'))
+
+    def find_groups_not_listed(self, groups, group_ids=None):
+        """Returns the sorted groups that aren't UserDefined groups in RT
+
+        :group_ids name -> id dictionary from group_ids(), loaded if not given"""
         if not groups:
             return []
         groups = sorted(groups)
 
-        rt_groups = [x.name for x in self.filter(domain=USER_DEFINED).order_by('name')]
-        if rt_groups:
-            return filter(lambda x: x not in rt_groups, groups)
-        else:
-            return groups
+        if group_ids is None:
+            group_ids = set(self.filter(domain=USER_DEFINED).values_list('name', flat=True))
+        return [x for x in groups if x not in group_ids]
+
+    def create_groups(self, groups, group_ids, batch_size=DEFAULT_BATCH_SIZE, throttle=None):
+        """Creates UserDefined groups in bulk and adds them to group_ids
+
+        Every group gets its principal and the cachedgroupmembers row of
+        the group itself, like RT creates them, each batch committed in
+        its own transaction.
+
+        :groups names of the groups to create, see find_groups_not_listed
+        :group_ids name -> id dictionary that is kept up to date
+        :throttle throttle.WriteThrottle sizing the batches instead of
+        batch_size, told how long every batch took to commit"""
+        groups = list(groups)
+        offset = 0
+        while offset < len(groups):
+            names = groups[offset:offset + (throttle.batch_size if throttle else batch_size)]
+            offset += len(names)
+            start = time.time()
+            with transaction.commit_on_success(using=self.db):
+                ids = RtPrincipal.objects.create_principals(PRINCIPAL_GROUP, len(names))
+                self.bulk_create([self.model(id=group_id, name=name, domain=USER_DEFINED, type=USER_DEFINED)
+                                  for group_id, name in zip(ids, names)])
+                RtCachedGroupMember.objects.add_groups(ids)
+            seconds = time.time() - start
+            group_ids.update(zip(names, ids))
+            if throttle:
+                # A principals, a groups and a cachedgroupmembers row per group
+                throttle.after_batch(3 * len(names), seconds)
+        return group_ids
 
 class RtGroup(models.Model):
     """Represents the 'groups' table in RT"""
@@ -93,16 +335,273 @@ class RtGroup(models.Model):
         db_table = 'groups'
 
 
+class MembershipChanges(object):
+    """Change plan computed by RtGroupMemberManager.diff_memberships
+
+    additions: set of (member id, group name) pairs missing in RT
+    removals: dict of groupmember id -> (member id, group name) for
+    RT memberships that are no longer in LDAP
+    """
+    def __init__(self):
+        self.additions = set()
+        self.removals = {}
+
+    def __len__(self):
+        return len(self.additions) + len(self.removals)
+
+    def per_group(self):
+        """Returns dict of group name -> [memberships to add, memberships to remove]"""
+        groups = {}
+        for member_id, groupname in self.additions:
+            groups.setdefault(groupname, [0, 0])[0] += 1
+        for member_id, groupname in self.removals.itervalues():
+            groups.setdefault(groupname, [0, 0])[1] += 1
+        return groups
+
+    def batches(self, batch_size=DEFAULT_BATCH_SIZE):
+        """Splits the plan into batches of roughly batch_size changes
+
+        A user's changes are never split across batches, so a user
+        with more changes than batch_size gets a batch of its own.
+
+        :batch_size changes per batch, or a function returning it, called
+        again for every batch
+
+        :returns generator of (additions, removals) where additions is a
+        list of (member id, group name) and removals a list of groupmember ids"""
+        per_member = {}
+        for member_id, groupname in self.additions:
+            per_member.setdefault(member_id, ([], []))[0].append(groupname)
+        for row_id, (member_id, groupname) in self.removals.iteritems():
+            per_member.setdefault(member_id, ([], []))[1].append(row_id)
+
+        next_size = batch_size if callable(batch_size) else lambda: batch_size
+        limit = next_size()
+        batch_additions, batch_removals = [], []
+        for member_id in sorted(per_member):
+            groupnames, row_ids = per_member[member_id]
+            size = len(batch_additions) + len(batch_removals)
+            if size and size + len(groupnames) + len(row_ids) > limit:
+                yield batch_additions, batch_removals
+                batch_additions, batch_removals = [], []
+                limit = next_size()
+            batch_additions.extend((member_id, groupname) for groupname in sorted(groupnames))
+            batch_removals.extend(sorted(row_ids))
+
+        if batch_additions or batch_removals:
+            yield batch_additions, batch_removals
+
+
 class RtGroupMemberManager(models.Manager):
+    def _rt_group_names(self, user):
+        return set(self.filter(member=user, group__domain=USER_DEFINED).values_list('group__name', flat=True))
+
     def extra_ldap_groups(self, user, ldap_groups):
         """Returns a list of ldap groups not added in RT"""
-        rt_groups = [x.group.name for x in self.filter(member=user, group__domain=USER_DEFINED).order_by('group__name').all()]
-        return filter(lambda x: x not in rt_groups, ldap_groups)
+        rt_groups = self._rt_group_names(user)
+        return [x for x in ldap_groups if x not in rt_groups]
 
     def extra_rt_groups(self, user, ldap_groups):
         """Returns a list of RT groups that is not a part of ldap_groups"""
-        rt_groups = [x.group.name for x in self.filter(member=user, group__domain=USER_DEFINED).order_by('group__name').all()]
-        return filter(lambda x: x not in ldap_groups, rt_groups)
+        ldap_groups = set(ldap_groups)
+        return [x for x in sorted(self._rt_group_names(user)) if x not in ldap_groups]
+
+    def user_defined_memberships(self, groups=None, group_names=None, member_ids=None):
+        """Returns the UserDefined membership relation
+
+        :groups only load memberships of these group names
+        :group_names matrix.Interner shared with the LDAP side
+        :member_ids only load memberships of these members, can't be
+        combined with groups
+        :returns MembershipMatrix of member id -> group names, with the
+        groupmember ids as values"""
+        if groups is not None:
+            groups = sorted(groups)
+            querysets = [self.filter(group__domain=USER_DEFINED, group__name__in=groups[offset:offset + DEFAULT_BATCH_SIZE])
+                         for offset in range(0, len(groups), DEFAULT_BATCH_SIZE)]
+        elif member_ids is not None:
+            member_ids = sorted(member_ids)
+            querysets = [self.filter(group__domain=USER_DEFINED, member__in=member_ids[offset:offset + DEFAULT_BATCH_SIZE])
+                         for offset in range(0, len(member_ids), DEFAULT_BATCH_SIZE)]
+        else:
+            querysets = [self.filter(group__domain=USER_DEFINED)]
+
+        rt_matrix = MembershipMatrix(group_names, values=True)
+        for queryset in querysets:
+            for row_id, member_id, groupname in queryset.values_list('id', 'member', 'group__name').iterator():
+                rt_matrix.add(member_id, groupname, row_id)
+        return rt_matrix.freeze()
+
+    def member_names(self, groups):
+        """Returns the names of the users in the given UserDefined groups"""
+        groups = sorted(groups)
+        names = set()
+        for offset in range(0, len(groups), DEFAULT_BATCH_SIZE):
+            names.update(self.filter(group__domain=USER_DEFINED, group__name__in=groups[offset:offset + DEFAULT_BATCH_SIZE])
+                         .values_list('member__name', flat=True))
+        return names
+
+    def diff_memberships(self, users, ldap_index, load_all=True):
+        """Computes the membership changes for every user at once
+
+        :users RT users to reconcile, anything with id and name
+        :ldap_index MembershipMatrix or dict of username -> set of LDAP group names
+        :load_all read every UserDefined membership in one scan, or only
+        the ones of users, a chunk at a time, when they are a small part
+        :returns MembershipChanges"""
+        if not isinstance(ldap_index, MembershipMatrix):
+            ldap_index = MembershipMatrix.from_index(ldap_index)
+        users = list(users)
+        member_ids = None if load_all else [user.id for user in users]
+        return self._diff(users, ldap_index,
+                          self.user_defined_memberships(group_names=ldap_index.groups, member_ids=member_ids))
+
+    def diff_group_memberships(self, users, group_members):
+        """Computes the membership changes of a few groups only
+
+        Used by incremental syncs, where only changed groups are known.
+
+        :users RT users to reconcile, anything with id and name
+        :group_members dict of group name -> set of LDAP member usernames
+        :returns MembershipChanges"""
+        ldap_index = MembershipMatrix.from_pairs((username, groupname) for groupname, members in group_members.iteritems()
+                                                 for username in members)
+        return self._diff(users, ldap_index, self.user_defined_memberships(group_members.keys(), ldap_index.groups))
+
+    def _diff(self, users, ldap_matrix, rt_matrix):
+        """Compares the rows of two matrices sharing their group ids"""
+        changes = MembershipChanges()
+        names = ldap_matrix.groups.names
+        for user in users:
+            ldap_groups = ldap_matrix.row(user.name)[0]
+            rt_groups, row_ids = rt_matrix.row(user.id)
+
+            for i in sorted_difference(ldap_groups, rt_groups):
+                changes.additions.add((user.id, names[ldap_groups[i]]))
+            for i in sorted_difference(rt_groups, ldap_groups):
+                changes.removals[row_ids[i]] = (user.id, names[rt_groups[i]])
+        return changes
+
+    def apply_changes(self, changes, group_ids, batch_size=DEFAULT_BATCH_SIZE, on_batch=None, throttle=None):
+        """Writes a MembershipChanges plan to RT
+
+        Each batch is one bulk insert and one DELETE ... WHERE id IN (...),
+        and the cachedgroupmembers rows of the batch's users brought up to
+        date, committed in its own transaction.
+
+        :group_ids dict of group name -> group id
+        :on_batch called with the highest member id of every committed
+        batch, batches go through the members in id order
+        :throttle throttle.WriteThrottle sizing the batches instead of
+        batch_size, told how long every batch took to commit
+        :returns tuple of (rows inserted, rows deleted)"""
+        inserted = deleted = 0
+        for additions, removals in changes.batches((lambda: throttle.batch_size) if throttle else batch_size):
+            start = time.time()
+            with transaction.commit_on_success(using=self.db):
+                if additions:
+                    self.bulk_create([self.model(group_id=group_ids[groupname], member_id=member_id)
+                                      for member_id, groupname in additions])
+                if removals:
+                    DeleteQuery(self.model).delete_batch(removals, self.db)
+                member_ids = set(member_id for member_id, groupname in additions)
+                member_ids.update(changes.removals[row_id][0] for row_id in removals)
+                RtCachedGroupMember.objects.refresh(', '.join(['%s'] * len(member_ids)), sorted(member_ids))
+            seconds = time.time() - start
+            inserted += len(additions)
+            deleted += len(removals)
+            if on_batch:
+                on_batch(max(member_ids))
+            if throttle:
+                throttle.after_batch(len(additions) + len(removals), seconds)
+        return inserted, deleted
+
+    def reconcile_from_staging(self, memberships, usernames, batch_size=DEFAULT_BATCH_SIZE):
+        """Reconciles UserDefined memberships inside the database
+
+        The LDAP memberships and the users to sync are loaded into
+        temporary tables, and the difference is applied with one
+        INSERT ... SELECT ... WHERE NOT EXISTS and one
+        DELETE ... WHERE NOT EXISTS, all in a single transaction together
+        with the cachedgroupmembers rows of the synced users.
+        Groups have to exist in RT beforehand.
+
+        The tests run these statements on SQLite only, which doesn't check
+        column types, so they keep to plain SQL-92 and leave no parameter's
+        type to be inferred through DISTINCT, UNION or CASE, for
+        PostgreSQL and MySQL.
+
+        :memberships iterable of (username, group name) pairs in LDAP
+        :usernames the users to reconcile
+        :returns tuple of (rows inserted, rows deleted)"""
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        tables = {
+            'staging': qn(STAGING_TABLE),
+            'scope': qn(SCOPE_TABLE),
+            'users': qn(RtUser._meta.db_table),
+            'groups': qn(RtGroup._meta.db_table),
+            'groupmembers': qn(self.model._meta.db_table),
+        }
+
+        with transaction.commit_on_success(using=self.db):
+            cursor = connection.cursor()
+            # All DDL first, the sqlite3 module commits before every DDL statement
+            for table in ('staging', 'scope'):
+                cursor.execute('DROP TABLE IF EXISTS %s' % tables[table])
+            cursor.execute('CREATE TEMPORARY TABLE %(staging)s (username varchar(200) NOT NULL, '
+                           'groupname varchar(200) NOT NULL)' % tables)
+            cursor.execute('CREATE TEMPORARY TABLE %(scope)s (username varchar(200) NOT NULL)' % tables)
+            cursor.execute('CREATE INDEX %s ON %s (groupname, username)' % (qn(STAGING_TABLE + '_idx'), tables['staging']))
+            cursor.execute('CREATE INDEX %s ON %s (username)' % (qn(SCOPE_TABLE + '_idx'), tables['scope']))
+
+            self._load(cursor, 'INSERT INTO %(staging)s (username, groupname) VALUES (%%s, %%s)' % tables,
+                       memberships, batch_size)
+            self._load(cursor, 'INSERT INTO %(scope)s (username) VALUES (%%s)' % tables,
+                       ((username,) for username in usernames), batch_size)
+
+            # DISTINCT in a derived table, on PostgreSQL a DISTINCT over the
+            # parameters would type lastupdated as text
+            cursor.execute('INSERT INTO %(groupmembers)s (groupid, memberid, creator, lastupdatedby, lastupdated) '
+                           'SELECT m.groupid, m.memberid, %%s, %%s, %%s '
+                           'FROM (SELECT DISTINCT g.id AS groupid, u.id AS memberid '
+                           'FROM %(staging)s s '
+                           'JOIN %(scope)s sc ON sc.username = s.username '
+                           'JOIN %(users)s u ON u.name = s.username '
+                           'JOIN %(groups)s g ON g.name = s.groupname AND g.domain = %%s '
+                           'WHERE NOT EXISTS (SELECT 1 FROM %(groupmembers)s gm '
+                           'WHERE gm.groupid = g.id AND gm.memberid = u.id)) m' % tables,
+                           [USER_ID_DEFAULT, USER_ID_DEFAULT,
+                            connection.ops.value_to_db_datetime(timezone.now()), USER_DEFINED])
+            inserted = cursor.rowcount
+
+            cursor.execute('DELETE FROM %(groupmembers)s '
+                           'WHERE groupid IN (SELECT g.id FROM %(groups)s g WHERE g.domain = %%s) '
+                           'AND memberid IN (SELECT u.id FROM %(users)s u JOIN %(scope)s sc ON sc.username = u.name) '
+                           'AND NOT EXISTS (SELECT 1 FROM %(staging)s s '
+                           'JOIN %(users)s u ON u.name = s.username '
+                           'JOIN %(groups)s g ON g.name = s.groupname AND g.domain = %%s '
+                           'WHERE g.id = %(groupmembers)s.groupid AND u.id = %(groupmembers)s.memberid)' % tables,
+                           [USER_DEFINED, USER_DEFINED])
+            deleted = cursor.rowcount
+
+            RtCachedGroupMember.objects.refresh('SELECT u.id FROM %(users)s u JOIN %(scope)s sc ON sc.username = u.name'
+                                                % tables)
+
+            # Emptied rather than dropped, the temporary tables go away with the connection
+            for table in ('staging', 'scope'):
+                cursor.execute('DELETE FROM %s' % tables[table])
+        return inserted, deleted
+
+    def _load(self, cursor, sql, rows, batch_size):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                cursor.executemany(sql, batch)
+                batch = []
+        if batch:
+            cursor.executemany(sql, batch)
 
 class RtGroupMember(models.Model):
     """Represents the 'groupmembers' table in RT"""
@@ -118,3 +617,75 @@ class RtGroupMember(models.Model):
     class Meta:
         db_table = 'groupmembers'
         unique_together = ('group', 'member')
+
+
+class RtCachedGroupMemberManager(models.Manager):
+    def add_groups(self, group_ids):
+        """Adds the row RT keeps for every group being a member of itself"""
+        self.bulk_create([self.model(group_id=group_id, member_id=group_id, via=0, immediate_parent_id=group_id)
+                          for group_id in group_ids])
+        self.filter(via=0, member_id__in=group_ids).update(via=F('id'))
+
+    def refresh(self, members_sql, params=()):
+        """Brings the UserDefined group rows of some members up to date with groupmembers
+
+        Rows of memberships that are gone are deleted. Missing rows are
+        inserted, a direct row per membership and a row for every group
+        the group is itself a member of, with via and immediateparentid
+        set like RT does. Runs in the caller's transaction.
+
+        :members_sql SQL giving the member ids, a subquery or placeholders
+        :params parameters of members_sql"""
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        tables = {
+            'cached': qn(self.model._meta.db_table),
+            'groupmembers': qn(RtGroupMember._meta.db_table),
+            'groups': qn(RtGroup._meta.db_table),
+            'members': members_sql,
+        }
+        params = list(params)
+        cursor = connection.cursor()
+
+        cursor.execute('DELETE FROM %(cached)s WHERE memberid IN (%(members)s) '
+                       'AND immediateparentid IN (SELECT g.id FROM %(groups)s g WHERE g.domain = %%s) '
+                       'AND NOT EXISTS (SELECT 1 FROM %(groupmembers)s gm '
+                       'WHERE gm.groupid = %(cached)s.immediateparentid AND gm.memberid = %(cached)s.memberid)' % tables,
+                       params + [USER_DEFINED])
+        cursor.execute('INSERT INTO %(cached)s (groupid, memberid, via, immediateparentid, disabled) '
+                       'SELECT gm.groupid, gm.memberid, 0, gm.groupid, 0 '
+                       'FROM %(groupmembers)s gm JOIN %(groups)s g ON g.id = gm.groupid '
+                       'WHERE g.domain = %%s AND gm.memberid IN (%(members)s) '
+                       'AND NOT EXISTS (SELECT 1 FROM %(cached)s c WHERE c.groupid = gm.groupid '
+                       'AND c.memberid = gm.memberid AND c.immediateparentid = gm.groupid)' % tables,
+                       [USER_DEFINED] + params)
+        cursor.execute('UPDATE %(cached)s SET via = id WHERE via = 0 AND memberid IN (%(members)s)' % tables, params)
+        # The groups containing the group, found through the group's own rows
+        cursor.execute('INSERT INTO %(cached)s (groupid, memberid, via, immediateparentid, disabled) '
+                       'SELECT a.groupid, d.memberid, a.id, d.groupid, a.disabled '
+                       'FROM %(cached)s d JOIN %(groups)s g ON g.id = d.groupid '
+                       'JOIN %(cached)s a ON a.memberid = d.groupid AND a.groupid <> a.memberid '
+                       'WHERE g.domain = %%s AND d.memberid IN (%(members)s) AND d.via = d.id '
+                       'AND NOT EXISTS (SELECT 1 FROM %(cached)s x WHERE x.groupid = a.groupid '
+                       'AND x.memberid = d.memberid AND x.via = a.id)' % tables,
+                       [USER_DEFINED] + params)
+
+
+class RtCachedGroupMember(models.Model):
+    """Represents the 'cachedgroupmembers' table in RT
+
+    groupmembers with nested groups flattened, RT reads rights from it.
+    groupid and memberid are principal ids. RT indexes (groupid, memberid,
+    disabled), (memberid, groupid, disabled) and (memberid,
+    immediateparentid), Django 1.4 only declares their first columns."""
+    id = models.AutoField(primary_key=True)
+    group_id = models.IntegerField(db_column='groupid', db_index=True)
+    member_id = models.IntegerField(db_column='memberid', db_index=True)
+    via = models.IntegerField()
+    immediate_parent_id = models.IntegerField(db_column='immediateparentid')
+    disabled = models.IntegerField(default=0)
+
+    objects = RtCachedGroupMemberManager()
+
+    class Meta:
+        db_table = 'cachedgroupmembers'
@@ -0,0 +1,150 @@
+"""Nested group expansion
+
+Besides posixGroups with memberUid, a directory may have groupOfNames
+groups listing member DNs, which can be users or other groups.
+GroupGraph holds every group's direct members and expands each group
+to the users of all groups nested in it.
+
+The expansion walks the graph once (Tarjan's strongly connected
+components), so a subgroup shared by many groups is expanded once, and
+groups nested in each other in a cycle all get the members of the
+whole cycle instead of recursing forever.
+"""
+from __future__ import absolute_import
+
+import logging
+
+import ldap.dn
+
+logger = logging.getLogger('rt_ldap_sync')
+
+
+def normalize_dn(dn):
+    """Comparable form of a DN, attribute types and values lowercased"""
+    return tuple(tuple((attribute.lower(), value.lower()) for attribute, value, flags in rdn)
+                 for rdn in ldap.dn.str2dn(dn))
+
+
+class GroupGraph(object):
+    def __init__(self, user_id_attribute='uid'):
+        self.user_id_attribute = user_id_attribute.lower()
+        self._users = {}
+        self._subgroups = {}
+        self._member_dns = {}
+        self._group_dns = {}
+        self._closure = None
+        # Lists of group names nested in each other, found by expand()
+        self.cycles = []
+        # Member DNs that are neither a known group nor a user
+        self.unresolved = set()
+
+    def __contains__(self, name):
+        return name in self._users
+
+    def names(self):
+        return self._users.keys()
+
+    def add_group(self, name, dn=None, usernames=(), member_dns=()):
+        """Adds a group's direct members, adding a group twice merges them"""
+        self._users.setdefault(name, set()).update(usernames)
+        self._subgroups.setdefault(name, set())
+        self._member_dns.setdefault(name, []).extend(member_dns)
+        if dn:
+            self._group_dns[normalize_dn(dn)] = name
+        self._closure = None
+
+    def resolve(self, lookup=None):
+        """Sorts the member DNs into users and subgroups
+
+        A DN is a subgroup if it's the DN of a known group, and a user if
+        its first RDN is the user id attribute (uid=x,ou=people,...).
+
+        :lookup called with the remaining DNs if any, returns a dict of
+        DN -> username for the ones that are users"""
+        remaining = []
+        for name, member_dns in self._member_dns.iteritems():
+            for dn in member_dns:
+                key = normalize_dn(dn)
+                if key in self._group_dns:
+                    self._subgroups[name].add(self._group_dns[key])
+                elif key and len(key[0]) == 1 and key[0][0][0] == self.user_id_attribute:
+                    self._users[name].add(ldap.dn.str2dn(dn)[0][0][1])
+                else:
+                    remaining.append((name, dn, key))
+        self._member_dns = dict((name, []) for name in self._users)
+
+        usernames = {}
+        if remaining and lookup:
+            for dn, username in lookup([member_dn for group, member_dn, member_key in remaining]).iteritems():
+                usernames[normalize_dn(dn)] = username
+        for name, dn, key in remaining:
+            if key in usernames:
+                self._users[name].add(usernames[key])
+            else:
+                self.unresolved.add(dn)
+        if self.unresolved:
+            logger.warning('%d group member DNs are neither users nor groups', len(self.unresolved))
+        self._closure = None
+
+    def members(self, name):
+        """The users of a group and of every group nested in it"""
+        return self.expand().get(name, frozenset())
+
+    def expand(self):
+        """Returns a dict of group name -> frozenset of all its users"""
+        if self._closure is not None:
+            return self._closure
+
+        self._closure = {}
+        self.cycles = []
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = set()
+        for root in sorted(self._users):
+            if root in index:
+                continue
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(sorted(self._subgroups[root])))]
+            while work:
+                node, children = work[-1]
+                for child in children:
+                    if child not in index:
+                        index[child] = lowlink[child] = len(index)
+                        stack.append(child)
+                        on_stack.add(child)
+                        work.append((child, iter(sorted(self._subgroups[child]))))
+                        break
+                    elif child in on_stack:
+                        lowlink[node] = min(lowlink[node], index[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[node])
+                    if lowlink[node] == index[node]:
+                        component = []
+                        while not component or component[-1] != node:
+                            component.append(stack.pop())
+                            on_stack.discard(component[-1])
+                        self._close(component)
+        return self._closure
+
+    def _close(self, component):
+        """Expands a strongly connected component, groups nested in it are expanded before it"""
+        members = set()
+        names = set(component)
+        for name in component:
+            members.update(self._users[name])
+            for subgroup in self._subgroups[name]:
+                if subgroup not in names:
+                    members.update(self._closure[subgroup])
+        if len(component) > 1 or component[0] in self._subgroups[component[0]]:
+            logger.warning('Groups nested in each other: %s', ', '.join(sorted(component)))
+            self.cycles.append(sorted(component))
+
+        members = frozenset(members)
+        for name in component:
+            self._closure[name] = members
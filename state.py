@@ -0,0 +1,122 @@
+"""Sync state persisted between runs of sync_ldap_groups"""
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+
+DEFAULT_STATE_FILE = 'rt_ldap_sync_state.json'
+# Seconds after which a checkpoint's snapshot is too old to resume
+DEFAULT_SNAPSHOT_MAX_AGE = 6 * 3600
+
+logger = logging.getLogger('rt_ldap_sync')
+
+
+def write_atomically(path, content):
+    """Writes a file through a temporary file and a rename, so a crash
+    never leaves a truncated file behind and readers never see half a file"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.rt_ldap_sync')
+    with os.fdopen(fd, 'w') as tmp_file:
+        tmp_file.write(content)
+    os.rename(tmp_path, path)
+
+
+class SyncState(object):
+    """Small JSON document kept in a local file
+
+    high_water_mark: newest LDAP modifyTimestamp seen by a sync
+    last_full_run: unix time of the last full sync
+    checkpoint: progress of an unfinished sync run, see start_checkpoint()
+    """
+    def __init__(self, path, data=None):
+        self.path = path
+        self._data = data if data else {}
+
+    @classmethod
+    def load(cls, path):
+        """Loads the state, an empty state if the file doesn't exist"""
+        if not os.path.exists(path):
+            return cls(path)
+        with open(path) as state_file:
+            return cls(path, json.load(state_file))
+
+    def save(self):
+        write_atomically(self.path, json.dumps(self._data))
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def set(self, key, value):
+        self._data[key] = value
+
+    @property
+    def high_water_mark(self):
+        return self._data.get('high_water_mark')
+
+    @high_water_mark.setter
+    def high_water_mark(self, timestamp):
+        if timestamp and timestamp > self._data.get('high_water_mark'):
+            self._data['high_water_mark'] = timestamp
+
+    def is_full_run_due(self, full_interval):
+        """Is a full sync needed, given the hours allowed between full runs?"""
+        last_full_run = self._data.get('last_full_run')
+        if not self.high_water_mark or last_full_run is None:
+            return True
+        return time.time() - last_full_run >= full_interval * 3600
+
+    def mark_full_run(self):
+        self._data['last_full_run'] = time.time()
+
+    @property
+    def snapshot_path(self):
+        return self.path + '.snapshot'
+
+    @property
+    def checkpoint(self):
+        return self._data.get('checkpoint')
+
+    def start_checkpoint(self, snapshot):
+        """Saves what a sync run fetched from LDAP, so a failed run can be resumed
+
+        The snapshot goes to a file of its own next to the state file,
+        written once, while the small checkpoint in the state is saved
+        after every batch.
+
+        :snapshot JSON serializable dict"""
+        snapshot = dict(snapshot, id=uuid.uuid4().hex, created=time.time())
+        write_atomically(self.snapshot_path, json.dumps(snapshot))
+        self._data['checkpoint'] = {'snapshot': snapshot['id'], 'provisioned': False, 'applied_through': None}
+        self.save()
+
+    def load_snapshot(self, max_age=DEFAULT_SNAPSHOT_MAX_AGE):
+        """The snapshot of the checkpoint, None if there's nothing to resume
+
+        :max_age seconds, an older snapshot is out of date and refused"""
+        checkpoint = self.checkpoint
+        if not checkpoint or not os.path.exists(self.snapshot_path):
+            return None
+        with open(self.snapshot_path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+        if snapshot.get('id') != checkpoint['snapshot']:
+            return None
+        if time.time() - snapshot.get('created', 0) > max_age:
+            logger.warning('Not resuming the checkpoint from %s, it is older than %d seconds',
+                           time.ctime(snapshot.get('created', 0)), max_age)
+            return None
+        return snapshot
+
+    def update_checkpoint(self, **progress):
+        self._data['checkpoint'].update(progress)
+        self.save()
+
+    def clear_checkpoint(self):
+        """Forgets the checkpoint and its snapshot
+
+        :returns whether there was a checkpoint"""
+        checkpointed = self._data.pop('checkpoint', None) is not None
+        if os.path.exists(self.snapshot_path):
+            os.remove(self.snapshot_path)
+        return checkpointed
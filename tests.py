@@ -1,13 +1,33 @@
 """RT LDAP Sync tests"""
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import time
 import unittest
+from StringIO import StringIO
+import json
+import ldap
 import mock
 import simpleldap
 
-from django.db import IntegrityError
-from django.test import TestCase
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, IntegrityError
+from django.test import TestCase, TransactionTestCase
 
-from rt_ldap_sync.ldap import LdapController
-from rt_ldap_sync.models import RtGroup, USER_DEFINED, RT_QUEUE_ROLE, RtUser, RtGroupMember, USER_ID_DEFAULT
+from rt_ldap_sync.fakeldap import FakeDirectory, compile_filter, FilterSyntaxError, SCOPE_BASE, SCOPE_ONELEVEL, SCOPE_SUBTREE
+from rt_ldap_sync.instrumentation import SyncStats, HotSpotReport, observe_queries
+from rt_ldap_sync.ldap import LdapController, LdapConnectionPool, SearchCache, SimplePagedResultsControl
+from rt_ldap_sync.management.commands import sync_ldap_groups
+from rt_ldap_sync.matrix import MembershipMatrix, sorted_difference
+from rt_ldap_sync.nested import GroupGraph
+from rt_ldap_sync.settings import LDAP_BASE_SEARCH
+from rt_ldap_sync.state import SyncState
+from rt_ldap_sync.throttle import WriteThrottle
+from rt_ldap_sync.watch import GroupChangeCoalescer, PersistentSearchGroupWatcher, PollingGroupWatcher
+from rt_ldap_sync.models import RtGroup, USER_DEFINED, RT_QUEUE_ROLE, RtUser, RtGroupMember, RtUserRow, USER_ID_DEFAULT, MembershipChanges
+from rt_ldap_sync.models import RtPrincipal, RtCachedGroupMember, PRINCIPAL_GROUP, LockNotAvailable, advisory_lock
 
 
 class User(TestCase):
@@ -18,6 +38,32 @@ class User(TestCase):
     def test_returns_my_username(self):
         self.assertEqual('norangsh', self.user1.name)
 
+    def test_iter_rows_selects_id_and_name_in_batches(self):
+        user2 = RtUser.objects.create(name='fellingh')
+        with self.assertNumQueries(2):
+            rows = list(RtUser.objects.iter_rows(['norangsh', 'fellingh', 'unknown', 'norangsh'], batch_size=2))
+
+        self.assertEquals([RtUserRow(self.user1.id, 'norangsh'), RtUserRow(user2.id, 'fellingh')], sorted(rows))
+
+    def test_provision_creates_and_updates_changed_users(self):
+        RtUser.objects.create(name='root', id=USER_ID_DEFAULT)
+        RtUser.objects.filter(id=self.user1.id).update(realname='Old Name', emailaddress='norangsh@example.com')
+        unchanged = RtUser.objects.create(name='fellingh', realname='Fell', emailaddress='fellingh@example.com')
+
+        ldap_users = [('norangsh', u'New Name', 'norangsh@example.com'),
+                      ('fellingh', 'Fell', 'fellingh@example.com'),
+                      ('glennrub', u'Glenn R\xfcb', 'glennrub@example.com')]
+        self.assertEquals((1, 1), RtUser.objects.provision(ldap_users, dry_run=True))
+        self.assertFalse(RtUser.objects.filter(name='glennrub').exists())
+
+        self.assertEquals((1, 1), RtUser.objects.provision(ldap_users))
+
+        self.assertEquals((u'New Name', 'norangsh@example.com'),
+                          RtUser.objects.values_list('realname', 'emailaddress').get(id=self.user1.id))
+        self.assertEquals(u'Glenn R\xfcb', RtUser.objects.get(name='glennrub').realname)
+        self.assertEquals(unchanged.last_updated, RtUser.objects.get(id=unchanged.id).last_updated)
+        self.assertEquals((0, 0), RtUser.objects.provision(ldap_users))
+
 class Group(TestCase):
     def setUp(self):
         self.group2 = RtGroup.objects.create(name='awesomegroup', domain=RT_QUEUE_ROLE)
@@ -64,6 +110,30 @@ class Group(TestCase):
         RtGroup.objects.create(name='not_listed_in_ldap_groups', domain=USER_DEFINED)
         self.assertEquals(['foo'], RtGroup.objects.find_groups_not_listed(self.ldap_groups))
 
+    def test_find_groups_not_listed_with_group_ids(self):
+        self.group1 = RtGroup.objects.create(name='awesomegroup', domain=USER_DEFINED)
+        group_ids = RtGroup.objects.group_ids()
+
+        self.assertEquals({'awesomegroup': self.group1.id}, group_ids)
+        self.assertNumQueries(0, lambda: RtGroup.objects.find_groups_not_listed(self.ldap_groups, group_ids))
+        self.assertEquals(['foo'], RtGroup.objects.find_groups_not_listed(self.ldap_groups, group_ids))
+
+    def test_create_groups_with_principals(self):
+        group_ids = RtGroup.objects.create_groups(['bar'], {})
+
+        principal = RtPrincipal.objects.get(id=group_ids['bar'])
+        self.assertEquals((PRINCIPAL_GROUP, group_ids['bar']), (principal.principal_type, principal.object_id))
+        row = RtCachedGroupMember.objects.get(group_id=group_ids['bar'])
+        self.assertEquals((group_ids['bar'], row.id, group_ids['bar']), (row.member_id, row.via, row.immediate_parent_id))
+
+    def test_create_groups_updates_group_ids(self):
+        group_ids = RtGroup.objects.group_ids()
+        RtGroup.objects.create_groups(['bar', 'foo'], group_ids)
+
+        self.assertEquals(['bar', 'foo'], sorted(group_ids.keys()))
+        self.assertEquals(group_ids['foo'], RtGroup.objects.get(name='foo', domain=USER_DEFINED).id)
+        self.assertTrue(RtGroup.objects.has_group('bar'))
+
 class GroupMember(TestCase):
     """Testcases involving group membership"""
     def setUp(self):
@@ -126,6 +196,112 @@ class GroupMember(TestCase):
 
         self.assertEqual(['trollkom', 'xdotkom'], sorted(extra_ldap + extra_rt))
 
+    def test_diff_memberships(self):
+        RtGroupMember.objects.create(group=self.group1, member=self.user1)
+        self.group_xdotkom = RtGroup.objects.create(name='xdotkom', domain=USER_DEFINED)
+        member_xdotkom = RtGroupMember.objects.create(group=self.group_xdotkom, member=self.user1)
+
+        ldap_index = {'norangsh': set(['dotkom', 'trollkom'])}
+        changes = RtGroupMember.objects.diff_memberships([self.user1], ldap_index)
+
+        self.assertEqual(set([(self.user1.id, 'trollkom')]), changes.additions)
+        self.assertEqual({member_xdotkom.id: (self.user1.id, 'xdotkom')}, changes.removals)
+        self.assertEqual(2, len(changes))
+
+    def test_diff_memberships_user_missing_in_ldap(self):
+        member = RtGroupMember.objects.create(group=self.group1, member=self.user1)
+
+        changes = RtGroupMember.objects.diff_memberships([self.user1], {})
+
+        self.assertEqual(set(), changes.additions)
+        self.assertEqual([member.id], changes.removals.keys())
+
+    def test_diff_memberships_fixed_number_of_queries(self):
+        users = [RtUser.objects.create(name='user%d' % i) for i in range(10)]
+        ldap_index = dict((user.name, set(['dotkom'])) for user in users)
+
+        self.assertNumQueries(1, lambda: RtGroupMember.objects.diff_memberships(users, ldap_index))
+
+    def test_diff_group_memberships_only_touches_given_groups(self):
+        RtGroupMember.objects.create(group=self.group1, member=self.user1)
+        self.group_xdotkom = RtGroup.objects.create(name='xdotkom', domain=USER_DEFINED)
+        member_xdotkom = RtGroupMember.objects.create(group=self.group_xdotkom, member=self.user1)
+
+        changes = RtGroupMember.objects.diff_group_memberships([self.user1], {'xdotkom': set(), 'trollkom': set(['norangsh'])})
+
+        self.assertEqual(set([(self.user1.id, 'trollkom')]), changes.additions)
+        self.assertEqual({member_xdotkom.id: (self.user1.id, 'xdotkom')}, changes.removals)
+
+    def test_apply_changes(self):
+        member = RtGroupMember.objects.create(group=self.group1, member=self.user1)
+        self.group_xdotkom = RtGroup.objects.create(name='xdotkom', domain=USER_DEFINED)
+
+        changes = RtGroupMember.objects.diff_memberships([self.user1], {'norangsh': set(['xdotkom'])})
+        group_ids = {'dotkom': self.group1.id, 'xdotkom': self.group_xdotkom.id}
+
+        self.assertEqual((1, 1), RtGroupMember.objects.apply_changes(changes, group_ids))
+        self.assertEqual(['xdotkom'], [x.group.name for x in RtGroupMember.objects.filter(member=self.user1)])
+        self.assertFalse(RtGroupMember.objects.filter(id=member.id).exists())
+
+    def test_apply_changes_maintains_cachedgroupmembers(self):
+        group_ids = RtGroup.objects.create_groups(['parent', 'child'], {})
+        parent, child = group_ids['parent'], group_ids['child']
+        nested = RtCachedGroupMember.objects.create(group_id=parent, member_id=child, via=0, immediate_parent_id=parent)
+        RtCachedGroupMember.objects.filter(id=nested.id).update(via=nested.id)
+
+        changes = RtGroupMember.objects.diff_memberships([self.user1], {'norangsh': set(['child'])})
+        RtGroupMember.objects.apply_changes(changes, group_ids)
+
+        rows = RtCachedGroupMember.objects.filter(member_id=self.user1.id)
+        direct = rows.get(group_id=child)
+        self.assertEquals((direct.id, child), (direct.via, direct.immediate_parent_id))
+        self.assertEquals((nested.id, child), rows.filter(group_id=parent).values_list('via', 'immediate_parent_id')[0])
+
+        changes = RtGroupMember.objects.diff_memberships([self.user1], {})
+        RtGroupMember.objects.apply_changes(changes, group_ids)
+        self.assertFalse(RtCachedGroupMember.objects.filter(member_id=self.user1.id).exists())
+
+    def test_changes_per_group(self):
+        changes = MembershipChanges()
+        changes.additions.update([(1, 'dotkom'), (2, 'dotkom'), (1, 'arrkom')])
+        changes.removals[10] = (2, 'arrkom')
+
+        self.assertEqual({'dotkom': [2, 0], 'arrkom': [1, 1]}, changes.per_group())
+
+    def test_batches_never_split_a_user(self):
+        changes = MembershipChanges()
+        changes.additions.update([(1, 'a'), (1, 'b'), (1, 'c'), (2, 'a')])
+        changes.removals[10] = (2, 'b')
+
+        batches = list(changes.batches(batch_size=2))
+
+        self.assertEqual([([(1, 'a'), (1, 'b'), (1, 'c')], []),
+                          ([(2, 'a')], [10])], batches)
+
+    def test_apply_changes_throttled(self):
+        changes = MembershipChanges()
+        changes.additions.update((self.user1.id + i, 'dotkom') for i in range(4))
+        throttle = WriteThrottle(batch_size=1)
+        throttle.after_batch = mock.MagicMock(name='after_batch',
+                                              side_effect=lambda rows, seconds: setattr(throttle, 'batch_size', 3))
+
+        RtGroupMember.objects.apply_changes(changes, {'dotkom': self.group1.id}, throttle=throttle)
+
+        self.assertEquals([1, 3], [call[0][0] for call in throttle.after_batch.call_args_list])
+
+
+    def test_create_groups_throttled(self):
+        throttle = WriteThrottle(batch_size=1)
+        throttle.after_batch = mock.MagicMock(name='after_batch',
+                                              side_effect=lambda rows, seconds: setattr(throttle, 'batch_size', 2))
+
+        group_ids = RtGroup.objects.create_groups(['a', 'b', 'c'], {}, throttle=throttle)
+
+        # One group, then the two left, three rows for each
+        self.assertEquals([3, 6], [call[0][0] for call in throttle.after_batch.call_args_list])
+        self.assertEquals(set(['a', 'b', 'c']), set(group_ids))
+        self.assertEquals(3, RtGroup.objects.filter(name__in=['a', 'b', 'c']).count())
+
 
 #class Troll(object):
 #    class Connection(object):
@@ -312,3 +488,965 @@ class LDAPTestCase(unittest.TestCase):
                                                                        'fellingh']}]
         self.assertRaises(ValueError, lambda: self.module.get_groups_member('dot'))
 
+    def test_get_membership_index_without_connection(self):
+        self.assertRaises(simpleldap.ConnectionException, lambda: self.module.get_membership_index())
+
+    def test_get_membership_index(self):
+        self._mock_valid_connection()
+        self.assertTrue(self.module.connect('foo', 1))
+        self.module._iter_search_results = mock.MagicMock(name='ldap._iter_search_results')
+        self.module._iter_search_results.return_value = iter([{'cn': ['dotkom'],
+                                                               'memberUid': ['norangsh',
+                                                                             'fellingh']},
+                                                              {'cn': ['komiteer'],
+                                                               'memberUid': ['norangsh']},
+                                                              {'cn': ['empty']}])
+
+        index = self.module.get_membership_index()
+
+        self.assertEquals(1, self.module._iter_search_results.call_count)
+        self.assertEquals(set(['dotkom', 'komiteer']), index['norangsh'])
+        self.assertEquals(set(['dotkom']), index['fellingh'])
+        self.assertFalse('dagolap' in index)
+
+    def test_get_groups_changed_since(self):
+        self._mock_valid_connection()
+        self.assertTrue(self.module.connect('foo', 1, 'dc=online,dc=ntnu,dc=no'))
+        self.module._get_search_results = mock.MagicMock(name='ldap._get_search_results')
+        self.module._get_search_results.return_value = []
+
+        self.module.get_groups_changed_since('20121231235959Z')
+
+        self.module._get_search_results.assert_called_with('(&(objectClass=posixGroup)(modifyTimestamp>=20121231235959Z))',
+                                                            'ou=groups,dc=online,dc=ntnu,dc=no',
+                                                            ['cn', 'memberUid', 'modifyTimestamp'], use_cache=False)
+
+    def test_iter_users_without_connection(self):
+        self.assertRaises(simpleldap.ConnectionException, lambda: self.module.iter_users())
+
+    def test_search_results_from_plain_connection(self):
+        self._mock_valid_connection()
+        self.assertTrue(self.module.connect('foo', 1))
+        self.module.get_connection().search.return_value = [{'cn': ['dotkom']}]
+
+        self.assertEquals([{'cn': ['dotkom']}], list(self.module.iter_groups_all()))
+        self.assertEquals([{'cn': ['dotkom']}], self.module.get_groups_member('dotkom'))
+
+    def test_search_listeners_called_per_request(self):
+        self._mock_valid_connection()
+        self.assertTrue(self.module.connect('foo', 1))
+        self.module.get_connection().search.return_value = [{'cn': ['dotkom']}, {'cn': ['arrkom']}]
+        listener = mock.MagicMock(name='listener')
+        self.module.search_listeners.append(listener)
+
+        self.module.get_groups_all()
+
+        self.assertEquals(1, listener.call_count)
+        self.assertEquals(2, listener.call_args[0][4])
+
+    def test_cached_searches(self):
+        self._mock_valid_connection()
+        self.module.cache = SearchCache(60)
+        self.assertTrue(self.module.connect('foo', 1))
+        search = self.module.get_connection().search
+        search.return_value = [{'cn': ['dotkom']}]
+
+        self.module.get_groups_member('dotkom')
+        self.module.get_groups_member('dotkom')
+        self.module.get_groups_changed_since('20120101000000Z')
+        self.module.get_groups_changed_since('20120101000000Z')
+        self.assertEquals(3, search.call_count)
+
+        self.module.invalidate_cache()
+        self.module.get_groups_member('dotkom')
+        self.assertEquals(4, search.call_count)
+
+    def test_paged_search_follows_cookie(self):
+        self.module.connect('foo', 1)
+        connection = mock.MagicMock(simpleldap.Connection)
+        connection.connection = mock.MagicMock(name='python-ldap')
+        connection.to_items.side_effect = lambda rdata: rdata
+        self.module._connection = connection
+        self.module._page_size = 1
+
+        def page(cookie):
+            ctrl = mock.MagicMock(controlType=SimplePagedResultsControl.controlType, cookie=cookie)
+            return [ctrl]
+        connection.connection.result3.side_effect = [(None, [{'uid': ['a']}], None, page('next')),
+                                                     (None, [{'uid': ['b']}], None, page(''))]
+
+        self.assertEquals([{'uid': ['a']}, {'uid': ['b']}], list(self.module.iter_users()))
+        self.assertEquals(2, connection.connection.search_ext.call_count)
+
+    def _pipelined_connections(self, pages):
+        """simpleldap connections answering search_ext/result3 from pages, a dict of filter -> list of pages"""
+        calls = []
+
+        def connection():
+            connection = mock.MagicMock(simpleldap.Connection)
+            connection.connection = mock.MagicMock(name='python-ldap')
+            connection.to_items.side_effect = lambda rdata: rdata
+            sent = {}
+
+            def search_ext(base_dn, scope, ldap_filter, attributes, serverctrls):
+                msgid = len(calls)
+                calls.append(('search_ext', ldap_filter))
+                sent[msgid] = ldap_filter
+                return msgid
+
+            def result3(msgid):
+                ldap_filter = sent.pop(msgid)
+                calls.append(('result3', ldap_filter))
+                entries = pages[ldap_filter].pop(0)
+                if isinstance(entries, ldap.LDAPError):
+                    raise entries
+                cookie = 'more' if pages[ldap_filter] else ''
+                return None, entries, msgid, [mock.MagicMock(controlType=SimplePagedResultsControl.controlType,
+                                                             cookie=cookie)]
+            connection.connection.search_ext.side_effect = search_ext
+            connection.connection.result3.side_effect = result3
+            return connection
+
+        self.module._ldap_impl.Connection.side_effect = lambda *args: connection()
+        return calls
+
+    def test_pipelined_searches(self):
+        calls = self._pipelined_connections({'(cn=a)': [[{'cn': ['a']}], [{'cn': ['a2']}]],
+                                             '(cn=b)': [[{'cn': ['b']}]], '(cn=c)': [[]]})
+        self.module = LdapController(self.module._ldap_impl, pool_size=2, max_outstanding=2)
+        self.module.connect('foo', 1)
+
+        results = self.module.search_many([('(cn=a)', 'ou=groups', ['cn']), ('(cn=b)', 'ou=groups', ['cn']),
+                                           ('(cn=c)', 'ou=groups', ['cn'])])
+
+        self.assertEquals([[{'cn': ['a']}, {'cn': ['a2']}], [{'cn': ['b']}], []], results)
+        # Two searches outstanding at once, the third sent when the first one finished
+        self.assertEquals([('search_ext', '(cn=a)'), ('search_ext', '(cn=b)'), ('result3', '(cn=a)'),
+                           ('search_ext', '(cn=a)'), ('result3', '(cn=a)'), ('search_ext', '(cn=c)'),
+                           ('result3', '(cn=b)'), ('result3', '(cn=c)')], calls)
+
+    def test_start_search_overlaps_other_work(self):
+        calls = self._pipelined_connections({'(objectClass=posixGroup)': [[{'cn': ['dotkom']}]],
+                                             '(&(objectClass=posixGroup)(&(cn=dotkom)))': [[{'cn': ['dotkom']},
+                                                                                           {'cn': ['dotkom']}]]})
+        self.module.connect('foo', 1)
+
+        groups = self.module.start_groups_all()
+        member = self.module.start_groups_member('dotkom')
+        self.assertEquals(['search_ext', 'search_ext'], [call for call, ldap_filter in calls])
+
+        self.assertEquals([{'cn': ['dotkom']}], list(groups))
+        self.assertRaises(ValueError, member.result)
+        self.module.close()
+
+    def test_pipelined_search_retried_when_server_down(self):
+        calls = self._pipelined_connections({'(cn=a)': [ldap.SERVER_DOWN(), [{'cn': ['a']}]], '(cn=b)': [[{'cn': ['b']}]]})
+        self.module = LdapController(self.module._ldap_impl, pool_size=1, max_outstanding=2)
+        self.module.connect('foo', 1)
+        pool = self.module.get_pool()
+        pool._discard = mock.MagicMock(name='_discard')
+
+        results = self.module.search_many([('(cn=a)', 'ou=groups', ['cn']), ('(cn=b)', 'ou=groups', ['cn'])])
+
+        self.assertEquals([[{'cn': ['a']}], [{'cn': ['b']}]], results)
+        # Both searches were on the connection that went away, and resent on a new one
+        self.assertEquals(1, pool._discard.call_count)
+        self.assertEquals([('search_ext', '(cn=a)'), ('search_ext', '(cn=b)'), ('result3', '(cn=a)'),
+                           ('search_ext', '(cn=a)'), ('search_ext', '(cn=b)'), ('result3', '(cn=a)'),
+                           ('result3', '(cn=b)')], calls)
+        # Nothing left outstanding, so the connection is back in the pool
+        self.assertEquals([], self.module.get_pipeline()._connections)
+        self.assertEquals(1, pool._idle.qsize())
+
+    def test_pipelined_search_error(self):
+        self._pipelined_connections({'(cn=a)': [ldap.NO_SUCH_OBJECT()], '(cn=b)': [[{'cn': ['b']}]],
+                                     '(cn=c)': [[{'cn': ['c']}]]})
+        self.module = LdapController(self.module._ldap_impl, pool_size=1, max_outstanding=1)
+        self.module.connect('foo', 1)
+
+        failing = self.module.start_search('(cn=a)', 'ou=groups', ['cn'])
+        queued = self.module.start_search('(cn=b)', 'ou=groups', ['cn'])
+
+        self.assertRaises(ldap.NO_SUCH_OBJECT, failing.result)
+        self.assertRaises(ldap.NO_SUCH_OBJECT, list, failing)
+        # The failed search made room for the queued one, and the pipeline still works
+        self.assertEquals([{'cn': ['b']}], queued.result())
+        self.assertEquals([{'cn': ['c']}], self.module.start_search('(cn=c)', 'ou=groups', ['cn']).result())
+        pipeline = self.module.get_pipeline()
+        self.assertEquals(([], [], []), (pipeline._outstanding, pipeline._queued, pipeline._connections))
+
+    def test_get_groups_members_concurrently(self):
+        self.module.connect('foo', 1)
+        self.module._ldap_impl.Connection.side_effect = lambda *args: FakeConnection()
+
+        results = self.module.get_groups_members(['dotkom', 'arrkom', 'fagkom'])
+
+        self.assertEquals(['arrkom', 'dotkom', 'fagkom'], sorted(results.keys()))
+        self.assertEquals('(&(objectClass=posixGroup)(&(cn=arrkom)))', results['arrkom'][0]['filter'])
+
+    def test_get_members_by_group_in_chunks(self):
+        directory = FakeDirectory()
+        for name, members in (('dotkom', ['a', 'b']), ('Arrkom', ['b']), ('fagkom', []), ('trikom', ['c'])):
+            directory.add('cn=%s,ou=groups,dc=example' % name, objectClass=['posixGroup'], cn=[name], memberUid=members)
+        controller = LdapController(directory)
+        controller.connect('localhost', 389, 'dc=example')
+
+        members = controller.get_members_by_group(['dotkom', 'arrkom', 'fagkom', 'nokom', 'dotkom'], chunk_size=2)
+
+        self.assertEquals({'dotkom': set(['a', 'b']), 'arrkom': set(['b']), 'fagkom': set(), 'nokom': set()}, members)
+        self.assertEquals(2, directory.search_count)
+
+        members = controller.get_members_by_group(['Dotkom', 'dotkom'])
+        self.assertEquals({'Dotkom': set(['a', 'b']), 'dotkom': set(['a', 'b'])}, members)
+
+    def test_get_users_requests_only_synced_attributes(self):
+        self._mock_valid_connection()
+        self.module.connect('foo', 1, 'dc=online,dc=ntnu,dc=no')
+        self.module._get_search_results = mock.MagicMock(name='ldap._get_search_results')
+
+        self.module.get_users()
+
+        self.module._get_search_results.assert_called_with('(objectClass=posixAccount)', 'dc=online,dc=ntnu,dc=no',
+                                                            ['uid', 'displayName', 'mail'])
+
+    def test_get_groups_escapes_username(self):
+        self._mock_valid_connection()
+        self.module.connect('foo', 1, 'dc=online,dc=ntnu,dc=no')
+        self.module._get_search_results = mock.MagicMock(name='ldap._get_search_results')
+
+        self.module.get_groups('*)(cn=admin')
+
+        self.module._get_search_results.assert_called_with(r'(&(objectClass=posixGroup)(&(cn=*)(memberUid=\2a\29\28cn=admin)))',
+                                                            'ou=groups,dc=online,dc=ntnu,dc=no', ['cn', 'memberUid'])
+
+    def test_search_options_override_group_profile(self):
+        directory = FakeDirectory()
+        directory.add('cn=dotkom,ou=groups,dc=example', objectClass=['posixGroup'], cn=['dotkom'], memberUid=['a'])
+        directory.add('cn=dotkom,ou=teams,dc=example', objectClass=['groupOfNames'], cn=['dotkom'], member=['b'])
+        controller = LdapController(directory)
+        controller.connect('localhost', 389, 'dc=example')
+
+        options = {'base_dn': 'ou=teams', 'object_class': 'groupOfNames', 'member_attribute': 'member',
+                   'scope': SCOPE_ONELEVEL}
+        self.assertEquals([('b', 'dotkom')], list(controller.iter_membership_pairs(options)))
+        self.assertEquals([{'cn': ['dotkom'], 'member': ['b']}], controller.get_groups_member('dotkom', options))
+
+
+class FakeConnection(object):
+    """Stand-in for simpleldap.Connection returning the filter it got"""
+    def __init__(self):
+        self.closed = False
+
+    def search(self, ldap_filter, base_dn, attributes):
+        return [{'filter': ldap_filter}]
+
+    def close(self):
+        self.closed = True
+
+
+class LdapConnectionPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pool = LdapConnectionPool(FakeConnection, size=2, health_check=lambda connection: not connection.closed)
+
+    def test_connection_reused(self):
+        connection = self.pool.checkout()
+        self.pool.checkin(connection)
+        self.assertTrue(connection is self.pool.checkout())
+
+    def test_broken_connection_replaced(self):
+        connection = self.pool.checkout()
+        self.pool.checkin(connection, broken=True)
+        self.assertTrue(connection.closed)
+        self.assertFalse(connection is self.pool.checkout())
+
+    def test_unhealthy_connection_replaced(self):
+        connection = self.pool.checkout()
+        self.pool.checkin(connection)
+        connection.closed = True
+        self.assertFalse(connection is self.pool.checkout())
+
+    def test_connection_returned_after_any_error(self):
+        def fail(error):
+            with self.pool.connection():
+                raise error
+        for i in range(3):
+            self.assertRaises(ldap.NO_SUCH_OBJECT, fail, ldap.NO_SUCH_OBJECT())
+            self.assertRaises(FilterSyntaxError, fail, FilterSyntaxError('('))
+        self.assertRaises(ldap.SERVER_DOWN, fail, ldap.SERVER_DOWN())
+
+        connection = self.pool.checkout()
+        self.assertFalse(connection.closed)
+        self.pool.checkin(connection)
+
+    def test_pool_needs_a_size(self):
+        self.assertRaises(ValueError, lambda: LdapConnectionPool(FakeConnection, size=0))
+
+
+class SearchCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.cache = SearchCache(10, max_entries=2, negative_ttl=1, clock=lambda: self.now)
+
+    def _key(self, base_dn):
+        return ('(objectClass=posixGroup)', base_dn, ('cn',), SCOPE_SUBTREE)
+
+    def test_expires_after_ttl(self):
+        self.cache.put(self._key('ou=groups'), [{'cn': ['dotkom']}])
+        self.cache.put(self._key('ou=people'), [])
+        self.now = 5
+        self.assertEquals([{'cn': ['dotkom']}], self.cache.get(self._key('ou=groups')))
+        self.assertEquals(None, self.cache.get(self._key('ou=people')))
+        self.now = 10
+        self.assertEquals(None, self.cache.get(self._key('ou=groups')))
+        self.assertEquals({'hits': 1, 'misses': 2, 'evictions': 0, 'size': 0}, self.cache.stats())
+
+    def test_negative_results(self):
+        self.cache.put(self._key('ou=people'), [])
+        self.assertEquals([], self.cache.get(self._key('ou=people')))
+
+    def test_evicts_least_recently_used(self):
+        self.cache.put(self._key('ou=a'), [1])
+        self.cache.put(self._key('ou=b'), [2])
+        self.cache.get(self._key('ou=a'))
+        self.cache.put(self._key('ou=c'), [3])
+
+        self.assertEquals(None, self.cache.get(self._key('ou=b')))
+        self.assertEquals([1], self.cache.get(self._key('ou=a')))
+        self.assertEquals(1, self.cache.evictions)
+
+    def test_invalidate_related_bases(self):
+        self.cache.max_entries = 3
+        for base_dn in ('dc=example', 'ou=groups,dc=example', 'ou=people,dc=example'):
+            self.cache.put(self._key(base_dn), [base_dn])
+        self.cache.invalidate('OU=groups,dc=example')
+
+        self.assertEquals(None, self.cache.get(self._key('dc=example')))
+        self.assertEquals(None, self.cache.get(self._key('ou=groups,dc=example')))
+        self.assertEquals(['ou=people,dc=example'], self.cache.get(self._key('ou=people,dc=example')))
+
+
+class SyncStateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'state.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_full_run_due_without_state(self):
+        self.assertTrue(SyncState.load(self.path).is_full_run_due(24))
+
+    def test_save_and_load(self):
+        state = SyncState.load(self.path)
+        state.high_water_mark = '20121231235959Z'
+        state.mark_full_run()
+        state.save()
+
+        state = SyncState.load(self.path)
+        self.assertEquals('20121231235959Z', state.high_water_mark)
+        self.assertFalse(state.is_full_run_due(24))
+        self.assertTrue(state.is_full_run_due(0))
+
+    def test_old_snapshot_refused(self):
+        state = SyncState.load(self.path)
+        state.start_checkpoint({'scope': ['norangsh']})
+        self.assertEquals(['norangsh'], state.load_snapshot()['scope'])
+
+        with mock.patch('time.time', return_value=time.time() + 7 * 3600):
+            self.assertEquals(None, state.load_snapshot(6 * 3600))
+
+    def test_high_water_mark_never_moves_backwards(self):
+        state = SyncState(self.path)
+        state.high_water_mark = '20121231235959Z'
+        state.high_water_mark = '20120101000000Z'
+        state.high_water_mark = None
+        self.assertEquals('20121231235959Z', state.high_water_mark)
+
+
+class SyncStatsTestCase(TestCase):
+    def setUp(self):
+        self.stats = SyncStats()
+
+    def test_counts_per_phase(self):
+        with self.stats.phase('ldap_fetch'):
+            self.stats.on_search('(objectClass=posixGroup)', 'ou=groups', ['cn'], 0.1, 42)
+            self.stats.on_search('(objectClass=posixGroup)', 'ou=groups', ['cn'], 0.1, 8)
+        with self.stats.phase('apply'):
+            self.stats.count('rows_inserted', 3)
+        self.stats.count('rows_inserted', 100)
+
+        self.assertEquals(2, self.stats.phases['ldap_fetch']['ldap_requests'])
+        self.assertEquals(50, self.stats.phases['ldap_fetch']['ldap_entries'])
+        self.assertEquals(3, self.stats.totals()['rows_inserted'])
+        self.assertTrue('rows_inserted=3' in self.stats.summary())
+
+    def test_hot_spots_by_normalized_text(self):
+        hot_spots = HotSpotReport()
+        hot_spots.on_query('DELETE FROM "groupmembers" WHERE "id" IN (%s, %s)', 0.5)
+        hot_spots.on_query('DELETE FROM "groupmembers" WHERE "id" IN (%s, %s, %s)', 0.25)
+        hot_spots.on_query("SELECT 1 FROM users WHERE name = 'x'", 1.0)
+        hot_spots.on_search('(&(objectClass=posixGroup)(|(cn=a)(cn=b)))', 'ou=groups', ['cn'], 0.1, 2)
+        hot_spots.on_search('(&(objectClass=posixGroup)(|(cn=c)(cn=d)))', 'ou=groups', ['cn'], 0.2, 2)
+
+        self.assertEquals([('SELECT ? FROM users WHERE name = ?', 1, 1.0, 1.0, 0),
+                           ('DELETE FROM "groupmembers" WHERE "id" IN (?, ...)', 2, 0.75, 0.5, 0)],
+                          hot_spots.ranked(hot_spots.queries))
+        self.assertEquals([('(&(objectClass=posixGroup)(|(cn=?)...)) base=ou=groups attributes=cn', 2, 0.1 + 0.2, 0.2, 4)],
+                          hot_spots.ranked(hot_spots.searches))
+
+    def test_observe_queries(self):
+        from django.db import connection
+        with self.stats.phase('rt_load'):
+            with observe_queries(connection, self.stats.on_query):
+                list(RtUser.objects.all())
+                list(RtGroup.objects.all())
+            list(RtUser.objects.all())
+
+        self.assertEquals(2, self.stats.phases['rt_load']['db_queries'])
+
+    def test_write_prometheus(self):
+        with self.stats.phase('diff'):
+            pass
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'rt_ldap_sync.prom')
+            self.stats.write_prometheus(path)
+            with open(path) as prom_file:
+                content = prom_file.read()
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertTrue('rt_ldap_sync_db_queries{phase="diff"} 0\n' in content)
+        self.assertTrue('# TYPE rt_ldap_sync_phase_seconds gauge\n' in content)
+
+
+class FakeDirectoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = FakeDirectory()
+        self.directory.add('cn=dotkom,ou=groups,dc=example', objectClass=['posixGroup'],
+                           cn=['dotkom'], memberUid=['norangsh', 'fellingh'], modifyTimestamp=['20120101000000Z'])
+        self.directory.add('cn=arrkom,ou=groups,dc=example', objectClass=['posixGroup'],
+                           cn=['arrkom'], memberUid=['norangsh'], modifyTimestamp=['20120601000000Z'])
+        self.directory.add('uid=norangsh,ou=people,dc=example', objectClass=['posixAccount'], uid=['norangsh'])
+
+    def _names(self, ldap_filter, base_dn='dc=example', scope=SCOPE_SUBTREE):
+        return sorted(entry['cn'][0] for entry in self.directory.search(ldap_filter, base_dn, ['cn'], scope))
+
+    def test_filters(self):
+        self.assertEquals(['arrkom', 'dotkom'], self._names('(objectClass=posixGroup)'))
+        self.assertEquals(['dotkom'], self._names('(&(objectClass=posixGroup)(memberUid=fellingh))'))
+        self.assertEquals(['arrkom', 'dotkom'], self._names('(|(cn=dotkom)(cn=arrkom)(cn=nope))'))
+        self.assertEquals(['arrkom'], self._names('(&(cn=*)(!(cn=dot*)))'))
+        self.assertEquals(['arrkom'], self._names('(&(objectClass=posixGroup)(modifyTimestamp>=20120301000000Z))'))
+        self.assertEquals([], self._names('(objectClass=posixGroup)', 'ou=people,dc=example'))
+
+    def test_escaped_value(self):
+        self.assertFalse(compile_filter(r'(cn=\2a)')({'cn': ['dotkom']}))
+        self.assertTrue(compile_filter(r'(cn=\2a)')({'cn': ['*']}))
+
+    def test_invalid_filter(self):
+        self.assertRaises(FilterSyntaxError, lambda: compile_filter('(cn=dotkom'))
+        self.assertRaises(FilterSyntaxError, lambda: compile_filter('cn=dotkom'))
+
+    def test_only_requested_attributes_returned(self):
+        entry = self.directory.search('(cn=dotkom)', 'dc=example', ['cn'])[0]
+        self.assertEquals({'cn': ['dotkom']}, dict(entry))
+        self.assertEquals('cn=dotkom,ou=groups,dc=example', entry.dn)
+
+    def test_scope(self):
+        self.assertEquals([], self._names('(objectClass=posixGroup)', 'dc=example', SCOPE_ONELEVEL))
+        self.assertEquals(['dotkom'], self._names('(cn=*)', 'cn=dotkom,ou=groups,dc=example', SCOPE_BASE))
+
+    def test_modify_bumps_timestamp(self):
+        self.directory.modify('cn=dotkom,ou=groups,dc=example', '20130101000000Z', memberUid=['glennrub'])
+        self.assertEquals(['dotkom'], self._names('(modifyTimestamp>=20130101000000Z)', 'ou=groups,dc=example'))
+
+
+class InProcessPool(object):
+    """multiprocessing.Pool running the workers in the test's process and transaction"""
+    def __init__(self, processes, initializer=None):
+        pass
+
+    def map(self, function, iterable):
+        return map(function, iterable)
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class SyncCommandTestCase(TestCase):
+    def setUp(self):
+        self.groups_dn = 'ou=groups,%s' % LDAP_BASE_SEARCH
+        self.directory = FakeDirectory()
+        self.directory.add('cn=dotkom,%s' % self.groups_dn, objectClass=['posixGroup'],
+                           cn=['dotkom'], memberUid=['norangsh', 'fellingh'], modifyTimestamp=['20120101000000Z'])
+        self.directory.add('cn=arrkom,%s' % self.groups_dn, objectClass=['posixGroup'],
+                           cn=['arrkom'], memberUid=['norangsh'], modifyTimestamp=['20120101000000Z'])
+
+        RtUser.objects.create(name='root', id=USER_ID_DEFAULT)
+        self.norangsh = RtUser.objects.create(name='norangsh')
+        self.fellingh = RtUser.objects.create(name='fellingh')
+        self.dotkom = RtGroup.objects.create(name='dotkom', domain=USER_DEFINED)
+        self.old = RtGroup.objects.create(name='old', domain=USER_DEFINED)
+        RtGroupMember.objects.create(group=self.old, member=self.norangsh)
+
+        self.patcher = mock.patch('rt_ldap_sync.management.commands.sync_ldap_groups.Command.ldap_impl', self.directory)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def _command(self, **options):
+        command = sync_ldap_groups.Command()
+        command.options = dict((option.dest, option.default) for option in command.option_list if option.dest)
+        command.options.update(options)
+        command.stats = SyncStats()
+        command.ldap = LdapController(self.directory)
+        command.ldap.connect('localhost', 389, LDAP_BASE_SEARCH)
+        return command
+
+    def _memberships(self):
+        return sorted(RtGroupMember.objects.values_list('member__name', 'group__name'))
+
+    def test_sync(self):
+        call_command('sync_ldap_groups', 'dotkom')
+
+        self.assertEquals([('fellingh', 'dotkom'), ('norangsh', 'arrkom'), ('norangsh', 'dotkom')], self._memberships())
+
+    def test_dry_run_writes_nothing(self):
+        stdout = StringIO()
+        with mock.patch('sys.stdout', stdout):
+            call_command('sync_ldap_groups', 'dotkom', dry_run=True)
+        plan = json.loads(stdout.getvalue())
+
+        self.assertEquals(['arrkom'], plan['groups_to_create'])
+        self.assertEquals(3, plan['memberships_to_add'])
+        self.assertEquals({'add': 0, 'remove': 1}, plan['groups']['old'])
+        self.assertEquals([('norangsh', 'old')], self._memberships())
+
+    def test_sync_nested_groups(self):
+        self.directory.add('cn=komiteer,%s' % self.groups_dn, objectClass=['groupOfNames'], cn=['komiteer'],
+                           member=['cn=dotkom,%s' % self.groups_dn, 'uid=norangsh,ou=people,%s' % LDAP_BASE_SEARCH])
+        call_command('sync_ldap_groups', 'dotkom', nested=True)
+
+        self.assertEquals([('fellingh', 'dotkom'), ('fellingh', 'komiteer'), ('norangsh', 'arrkom'),
+                           ('norangsh', 'dotkom'), ('norangsh', 'komiteer')], self._memberships())
+
+    def test_sync_provisions_users(self):
+        self.directory.add('uid=glennrub,ou=people,%s' % LDAP_BASE_SEARCH, objectClass=['posixAccount'],
+                           uid=['glennrub'], displayName=['Glenn'], mail=['glennrub@example.com'])
+        self.directory.add('uid=outside,ou=people,%s' % LDAP_BASE_SEARCH, objectClass=['posixAccount'], uid=['outside'])
+        self.directory.modify('cn=dotkom,%s' % self.groups_dn, memberUid=['norangsh', 'fellingh', 'glennrub'])
+
+        call_command('sync_ldap_groups', 'dotkom', provision_users=True)
+
+        self.assertEquals('glennrub@example.com', RtUser.objects.get(name='glennrub').emailaddress)
+        self.assertFalse(RtUser.objects.filter(name='outside').exists())
+        self.assertIn(('glennrub', 'dotkom'), self._memberships())
+
+    def test_resume_continues_after_last_batch(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        command = self._command(resume=True, batch_size=1, state_file=os.path.join(directory, 'state.json'))
+        bulk_create = RtGroupMember.objects.bulk_create
+        failover = [bulk_create, mock.Mock(side_effect=DatabaseError('failover'))]
+        with mock.patch.object(RtGroupMember.objects, 'bulk_create', lambda objs: failover.pop(0)(objs)):
+            self.assertRaises(DatabaseError, command.handle, 'dotkom', **command.options)
+        self.assertEquals([('norangsh', 'arrkom'), ('norangsh', 'dotkom')], self._memberships())
+        self.assertEquals(self.norangsh.id, SyncState.load(command.options['state_file']).checkpoint['applied_through'])
+
+        # The rest comes from the checkpointed LDAP snapshot
+        self.directory.modify('cn=dotkom,%s' % self.groups_dn, memberUid=['norangsh'])
+        command.handle('dotkom', **command.options)
+
+        self.assertEquals([('fellingh', 'dotkom'), ('norangsh', 'arrkom'), ('norangsh', 'dotkom')], self._memberships())
+        self.assertEquals(None, SyncState.load(command.options['state_file']).checkpoint)
+        self.assertEquals(['state.json'], os.listdir(directory))
+
+    def test_profile_writes_report(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'profile.txt')
+        command = self._command(profile=path, profile_top=5)
+        command.handle('dotkom', **command.options)
+
+        with open(path) as report_file:
+            report = report_file.read()
+        self.assertIn('(&(objectClass=posixGroup)(cn=?)) base=ou=groups,%s' % LDAP_BASE_SEARCH, report)
+        self.assertIn('INSERT INTO "groupmembers"', report)
+        self.assertIn('Python functions by cumulative time', report)
+        self.assertTrue(os.path.exists(path + '.prof'))
+
+    def test_sync_workers(self):
+        command = self._command(workers=3)
+        with mock.patch('multiprocessing.Pool', InProcessPool):
+            command.handle('dotkom', **command.options)
+
+        self.assertEquals([('fellingh', 'dotkom'), ('norangsh', 'arrkom'), ('norangsh', 'dotkom')], self._memberships())
+        self.assertEquals(1 + 3, command.stats.totals()['rows_inserted'])
+        self.assertEquals(1, command.stats.totals()['rows_deleted'])
+
+    def test_sync_workers_provision_once(self):
+        self.directory.add('uid=glennrub,ou=people,%s' % LDAP_BASE_SEARCH, objectClass=['posixAccount'], uid=['glennrub'])
+        self.directory.modify('cn=dotkom,%s' % self.groups_dn, memberUid=['norangsh', 'fellingh', 'glennrub'])
+        command = self._command(workers=3, provision_users=True)
+        with mock.patch('multiprocessing.Pool', InProcessPool):
+            with mock.patch.object(LdapController, 'iter_user_records', autospec=True,
+                                   side_effect=LdapController.iter_user_records) as iter_user_records:
+                command.handle('dotkom', **command.options)
+
+        self.assertEquals(1, iter_user_records.call_count)
+        self.assertIn(('glennrub', 'dotkom'), self._memberships())
+
+    def test_sync_workers_forks(self):
+        def sync_partition(command, partition, usernames, membership_index, group_ids, options):
+            # In the worker, with the parent's database connection kept but not used
+            from django.db import connection
+            assert connection.connection is None and len(sync_ldap_groups._inherited_connections) == 1
+            stats = SyncStats()
+            with stats.phase('apply'):
+                stats.count('rows_inserted', len(usernames))
+            return stats.phases
+
+        command = self._command(workers=2)
+        with mock.patch.object(sync_ldap_groups.Command, '_sync_partition', sync_partition):
+            command.handle('dotkom', **command.options)
+
+        # Each worker counted its users, the parent created arrkom
+        self.assertEquals(2 + 1, command.stats.totals()['rows_inserted'])
+        self.assertTrue(RtGroup.objects.filter(name='arrkom').exists())
+
+    def test_partitions_are_stable(self):
+        self.assertEquals(sync_ldap_groups.partition_of(u'norangsh', 4), sync_ldap_groups.partition_of('norangsh', 4))
+        self.assertEquals(sync_ldap_groups.partition_of(u'n\xf8rangsh', 4), sync_ldap_groups.partition_of('n\xc3\xb8rangsh', 4))
+        self.assertEquals(set(range(4)), set(sync_ldap_groups.partition_of('user%d' % i, 4) for i in range(100)))
+
+    def test_overlapping_runs_fail(self):
+        command = self._command()
+        with advisory_lock(sync_ldap_groups.RUN_LOCK):
+            self.assertRaises(CommandError, command.handle, 'dotkom', **command.options)
+        self.assertEquals([('norangsh', 'old')], self._memberships())
+
+        with advisory_lock('%s partition 0/2' % sync_ldap_groups.RUN_LOCK):
+            command.handle('dotkom', **command.options)
+            self.assertRaises(LockNotAvailable, advisory_lock('%s partition 0/2' % sync_ldap_groups.RUN_LOCK).__enter__)
+
+    def test_failed_unlock_keeps_original_error(self):
+        connection = mock.MagicMock(name='connection', vendor='postgresql', alias='default')
+        cursor = connection.cursor.return_value
+        cursor.fetchone.return_value = [True]
+
+        def execute(sql, params):
+            if 'unlock' in sql:
+                raise DatabaseError('current transaction is aborted')
+        cursor.execute.side_effect = execute
+
+        def locked():
+            with advisory_lock(sync_ldap_groups.RUN_LOCK):
+                raise ValueError('sync failed')
+
+        with mock.patch('rt_ldap_sync.models.connections', {'default': connection}):
+            with mock.patch('django.db.transaction.rollback_unless_managed') as rollback:
+                self.assertRaises(ValueError, locked)
+        rollback.assert_called_once_with(using='default')
+        self.assertEquals(3, cursor.execute.call_count)
+
+    def test_incremental_runs_full_when_synced_groups_change(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        command = self._command(incremental=True, state_file=os.path.join(directory, 'state.json'))
+        command.handle('dotkom', **command.options)
+
+        RtUser.objects.create(name='glennrub')
+        # arrkom looks unchanged to the incremental search
+        self.directory.modify('cn=arrkom,%s' % self.groups_dn, '20110101000000Z', memberUid=['norangsh', 'glennrub'])
+        self.directory.modify('cn=dotkom,%s' % self.groups_dn, '20130101000000Z',
+                              memberUid=['norangsh', 'fellingh', 'glennrub'])
+        command.handle('dotkom', **command.options)
+
+        self.assertIn(('glennrub', 'arrkom'), self._memberships())
+        self.assertEquals('20130101000000Z', SyncState.load(command.options['state_file']).high_water_mark)
+
+    def test_successful_run_drops_stale_checkpoint(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        state_file = os.path.join(directory, 'state.json')
+        state = SyncState.load(state_file)
+        state.start_checkpoint({'incremental': False, 'groups': [], 'scope': [], 'high_water_mark': None,
+                                'memberships': {}})
+
+        command = self._command(state_file=state_file)
+        command.handle('dotkom', **command.options)
+
+        self.assertEquals(None, SyncState.load(state_file).checkpoint)
+        self.assertEquals(['state.json'], os.listdir(directory))
+
+    def test_sql_engine_only_does_full_syncs(self):
+        command = self._command(engine='sql', dry_run=True)
+        self.assertRaises(CommandError, command.handle, 'dotkom', **command.options)
+
+    def test_daemon_cycle_applies_changed_groups(self):
+        command = self._command(daemon=True, debounce=0)
+        state = SyncState(os.devnull)
+        state.save = mock.MagicMock(name='SyncState.save')
+        command._sync(['dotkom'], command.options, state)
+        self.assertEquals('20120101000000Z', state.high_water_mark)
+
+        watcher = PollingGroupWatcher(command.ldap, state.high_water_mark, interval=0)
+        coalescer = GroupChangeCoalescer(debounce=0)
+        self.directory.modify('cn=arrkom,%s' % self.groups_dn, '20130101000000Z', memberUid=['fellingh'])
+        command._daemon_cycle(['dotkom'], command.options, state, watcher, coalescer)
+
+        self.assertEquals([('fellingh', 'arrkom'), ('fellingh', 'dotkom'), ('norangsh', 'dotkom')], self._memberships())
+        self.assertEquals('20130101000000Z', state.high_water_mark)
+
+
+    def test_daemon_reconnects_after_ldap_errors(self):
+        command = self._command(daemon=True, poll_interval=3)
+        cycles = []
+
+        def daemon_cycle(*args):
+            cycles.append(command.ldap.is_connected())
+            if len(cycles) == 1:
+                raise ldap.SERVER_DOWN()
+            command._stopping = True
+
+        command._daemon_cycle = daemon_cycle
+        with mock.patch('time.sleep') as sleep:
+            command._daemon(['dotkom'], command.options, SyncState(os.devnull))
+
+        self.assertEquals([True, True], cycles)
+        sleep.assert_called_once_with(3)
+
+
+class PrincipalTransactionTestCase(TransactionTestCase):
+    """Outside the transaction every TestCase runs in"""
+    def test_principal_markers_never_committed(self):
+        with mock.patch('django.db.models.query.QuerySet.update', side_effect=DatabaseError('crash')):
+            self.assertRaises(DatabaseError, RtUser.objects.create, name='norangsh')
+        self.assertEquals(0, RtPrincipal.objects.count())
+
+
+class StagingTableTestCase(TransactionTestCase):
+    """reconcile_from_staging creates tables, which the sqlite3 module commits"""
+    def setUp(self):
+        RtUser.objects.create(name='root', id=USER_ID_DEFAULT)
+        self.norangsh = RtUser.objects.create(name='norangsh')
+        self.dotkom = RtGroup.objects.create(name='dotkom', domain=USER_DEFINED)
+
+    def test_reconcile_from_staging(self):
+        user2 = RtUser.objects.create(name='fellingh')
+        outside = RtUser.objects.create(name='outside')
+        group2 = RtGroup.objects.create(name='arrkom', domain=USER_DEFINED)
+        system = RtGroup.objects.create(name='Privileged', domain='SystemInternal')
+        for group, member in ((self.dotkom, user2), (group2, self.norangsh), (group2, outside), (system, self.norangsh)):
+            RtGroupMember.objects.create(group=group, member=member)
+
+        inserted, deleted = RtGroupMember.objects.reconcile_from_staging(
+            [('norangsh', 'dotkom'), ('fellingh', 'dotkom'), ('outside', 'dotkom'), ('norangsh', 'unknown')],
+            ['norangsh', 'fellingh'], batch_size=2)
+
+        self.assertEquals((1, 1), (inserted, deleted))
+        self.assertEquals([(self.dotkom.id, self.norangsh.id), (self.dotkom.id, user2.id)],
+                          sorted(RtCachedGroupMember.objects.values_list('group_id', 'member_id')))
+        self.assertEquals([('Privileged', 'norangsh'), ('arrkom', 'outside'), ('dotkom', 'fellingh'),
+                           ('dotkom', 'norangsh')],
+                          sorted(RtGroupMember.objects.values_list('group__name', 'member__name')))
+
+    def test_sync_sql_engine(self):
+        directory = FakeDirectory()
+        directory.add('cn=dotkom,ou=groups,%s' % LDAP_BASE_SEARCH, objectClass=['posixGroup'],
+                      cn=['dotkom'], memberUid=['norangsh'])
+        directory.add('cn=arrkom,ou=groups,%s' % LDAP_BASE_SEARCH, objectClass=['posixGroup'],
+                      cn=['arrkom'], memberUid=['norangsh'])
+        with mock.patch('rt_ldap_sync.management.commands.sync_ldap_groups.Command.ldap_impl', directory):
+            call_command('sync_ldap_groups', 'dotkom', engine='sql')
+
+        self.assertEquals([('arrkom', 'norangsh'), ('dotkom', 'norangsh')],
+                          sorted(RtGroupMember.objects.values_list('group__name', 'member__name')))
+
+
+class MembershipMatrixTestCase(unittest.TestCase):
+    def test_rows_sorted_and_shared_group_ids(self):
+        ldap_matrix = MembershipMatrix.from_pairs([('norangsh', 'dotkom'), ('fellingh', 'arrkom'),
+                                                   ('norangsh', 'arrkom'), ('norangsh', 'fagkom')])
+        rt_matrix = MembershipMatrix(ldap_matrix.groups, values=True)
+        rt_matrix.add(1, 'xdotkom', 11)
+        rt_matrix.add(1, 'dotkom', 10)
+        rt_matrix.freeze()
+
+        self.assertEquals(set(['dotkom', 'arrkom', 'fagkom']), ldap_matrix.groups_of('norangsh'))
+        self.assertEquals(sorted(ldap_matrix.row('norangsh')[0]), list(ldap_matrix.row('norangsh')[0]))
+        self.assertEquals(set(['xdotkom', 'dotkom']), rt_matrix.groups_of(1))
+        self.assertEquals([10, 11], list(rt_matrix.row(1)[1]))
+        self.assertEquals(0, len(rt_matrix.row(2)[0]))
+        self.assertEquals(4, len(ldap_matrix))
+
+    def test_frozen(self):
+        matrix = MembershipMatrix.from_pairs([])
+        self.assertRaises(ValueError, lambda: matrix.add('norangsh', 'dotkom'))
+
+    def test_sorted_difference(self):
+        self.assertEquals([0, 3], sorted_difference([1, 4, 5, 9], [2, 4, 5, 7]))
+        self.assertEquals([], sorted_difference([], [1]))
+        self.assertEquals([0, 1], sorted_difference([1, 2], []))
+
+
+class GroupGraphTestCase(unittest.TestCase):
+    def setUp(self):
+        self.graph = GroupGraph()
+        self.graph.add_group('online', 'cn=online,ou=groups,dc=example',
+                             member_dns=['cn=dotkom,ou=groups,dc=example', 'cn=arrkom,ou=groups,dc=example',
+                                         'uid=leader,ou=people,dc=example'])
+        self.graph.add_group('komiteer', 'cn=komiteer,ou=groups,dc=example',
+                             member_dns=['CN=dotkom,ou=groups,dc=example'])
+        self.graph.add_group('dotkom', 'cn=dotkom,ou=groups,dc=example', usernames=['norangsh'])
+        self.graph.add_group('arrkom', 'cn=arrkom,ou=groups,dc=example', usernames=['fellingh'])
+
+    def test_expands_shared_subgroups(self):
+        self.graph.resolve()
+
+        self.assertEquals(frozenset(['leader', 'norangsh', 'fellingh']), self.graph.members('online'))
+        self.assertEquals(frozenset(['norangsh']), self.graph.members('komiteer'))
+        self.assertEquals(frozenset(), self.graph.members('unknown'))
+        self.assertEquals([], self.graph.cycles)
+
+    def test_cycle(self):
+        self.graph.add_group('dotkom', member_dns=['cn=online,ou=groups,dc=example'])
+        self.graph.resolve()
+
+        self.assertEquals(frozenset(['leader', 'norangsh', 'fellingh']), self.graph.members('dotkom'))
+        self.assertEquals(frozenset(['leader', 'norangsh', 'fellingh']), self.graph.members('komiteer'))
+        self.assertEquals([['dotkom', 'online']], self.graph.cycles)
+
+    def test_member_dns_looked_up_once(self):
+        self.graph.add_group('arrkom', member_dns=['cn=Glenn,ou=people,dc=example', 'cn=gone,ou=people,dc=example'])
+        lookup = mock.MagicMock(name='lookup', return_value={'cn=glenn,ou=people,dc=example': 'glennrub'})
+        self.graph.resolve(lookup)
+
+        lookup.assert_called_once_with(['cn=Glenn,ou=people,dc=example', 'cn=gone,ou=people,dc=example'])
+        self.assertEquals(frozenset(['fellingh', 'glennrub']), self.graph.members('arrkom'))
+        self.assertEquals(set(['cn=gone,ou=people,dc=example']), self.graph.unresolved)
+
+    def test_deep_nesting(self):
+        graph = GroupGraph()
+        for i in range(2000):
+            graph.add_group('g%d' % i, 'cn=g%d,dc=example' % i, usernames=['u%d' % i],
+                            member_dns=['cn=g%d,dc=example' % (i + 1)])
+        graph.resolve()
+        self.assertEquals(2000, len(graph.members('g0')))
+
+
+class WriteThrottleTestCase(unittest.TestCase):
+    def setUp(self):
+        self.slept = []
+
+    def test_adapts_batch_size_to_latency(self):
+        throttle = WriteThrottle(target_latency=0.5, batch_size=100, sleep=self.slept.append)
+        throttle.after_batch(100, 0.1)
+        self.assertEquals(110, throttle.batch_size)
+        throttle.after_batch(110, 2.0)
+        self.assertEquals(55, throttle.batch_size)
+        self.assertEquals([1.5], self.slept)
+
+    def test_batch_size_bounds(self):
+        throttle = WriteThrottle(target_latency=0.5, batch_size=2, max_batch_size=3, sleep=self.slept.append)
+        for i in range(3):
+            throttle.after_batch(2, 0.1)
+        self.assertEquals(3, throttle.batch_size)
+        for i in range(3):
+            throttle.after_batch(2, 1.0)
+        self.assertEquals(1, throttle.batch_size)
+
+    def test_default_max_batch_size(self):
+        self.assertEquals(500, WriteThrottle(batch_size=100).max_batch_size)
+        self.assertEquals(200, WriteThrottle(batch_size=20).max_batch_size)
+        self.assertEquals(1000, WriteThrottle(batch_size=1000).max_batch_size)
+
+    def test_rate_limit(self):
+        throttle = WriteThrottle(max_rows_per_second=100, batch_size=50, sleep=self.slept.append)
+        throttle.after_batch(50, 0.2)
+        throttle.after_batch(50, 0.6)
+        self.assertEquals([0.3], self.slept)
+        self.assertEquals(50, throttle.batch_size)
+
+
+class WatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+
+    def clock(self):
+        return self.now
+
+    def test_coalescer_merges_and_debounces(self):
+        coalescer = GroupChangeCoalescer(debounce=2, max_delay=30, clock=self.clock)
+        self.assertEquals(5, coalescer.wait_time(5))
+
+        coalescer.add({'cn': ['dotkom'], 'memberUid': ['norangsh']})
+        self.now += 1
+        coalescer.add({'cn': ['dotkom'], 'memberUid': ['fellingh']})
+        self.assertFalse(coalescer.ready())
+        self.assertEquals(2, coalescer.wait_time(5))
+
+        self.now += 2
+        self.assertTrue(coalescer.ready())
+        self.assertEquals({'dotkom': {'cn': ['dotkom'], 'memberUid': ['fellingh']}}, coalescer.pop())
+        self.assertEquals(0, len(coalescer))
+
+    def test_coalescer_max_delay(self):
+        coalescer = GroupChangeCoalescer(debounce=2, max_delay=3, clock=self.clock)
+        for i in range(3):
+            coalescer.add({'cn': ['dotkom']})
+            self.now += 1
+        self.assertTrue(coalescer.ready())
+
+    def test_persistent_search_catches_up_when_started(self):
+        controller = mock.MagicMock(name='LdapController')
+        before = {'cn': ['dotkom'], 'modifyTimestamp': ['20120101000000Z']}
+        after = {'cn': ['arrkom'], 'modifyTimestamp': ['20120101000001Z']}
+        controller.get_groups_changed_since.return_value = [before]
+        controller.start_group_changes.side_effect = [True, False, False, True]
+        controller.iter_group_changes.side_effect = [iter([after]), ldap.SERVER_DOWN()]
+        watcher = PersistentSearchGroupWatcher(controller, PollingGroupWatcher(controller, '20111231000000Z'))
+
+        # Changes made before the search started are polled for
+        self.assertEquals([before], watcher.changes(5))
+        self.assertEquals([after], watcher.changes(5))
+        self.assertRaises(ldap.SERVER_DOWN, watcher.changes, 5)
+
+        # Restarted, polling from the last change seen
+        controller.get_groups_changed_since.return_value = [after, before]
+        self.assertEquals([before], watcher.changes(5))
+        self.assertEquals('20120101000001Z', controller.get_groups_changed_since.call_args[0][0])
+
+    def test_polling_watcher_skips_groups_seen_at_mark(self):
+        controller = mock.MagicMock(name='LdapController')
+        controller.get_groups_changed_since.return_value = [{'cn': ['dotkom'], 'modifyTimestamp': ['20120101000000Z']}]
+        watcher = PollingGroupWatcher(controller, interval=10, clock=self.clock, sleep=lambda seconds: None)
+
+        self.assertEquals(1, len(watcher.changes(5)))
+        self.assertEquals('20120101000000Z', watcher.high_water_mark)
+        self.assertEquals([], watcher.changes(5))
+
+        self.now += 10
+        self.assertEquals([], watcher.changes(5))
+        controller.get_groups_changed_since.assert_called_with('20120101000000Z')
+
+    def test_polling_watcher_sees_change_within_same_second(self):
+        controller = mock.MagicMock(name='LdapController')
+        controller.get_groups_changed_since.return_value = [
+            {'cn': ['dotkom'], 'memberUid': ['norangsh'], 'modifyTimestamp': ['20120101000000Z']}]
+        watcher = PollingGroupWatcher(controller, interval=0, clock=self.clock, sleep=lambda seconds: None)
+        self.assertEquals(1, len(watcher.changes(5)))
+
+        changed = {'cn': ['dotkom'], 'memberUid': ['norangsh', 'fellingh'], 'modifyTimestamp': ['20120101000000Z']}
+        controller.get_groups_changed_since.return_value = [changed]
+        self.assertEquals([changed], watcher.changes(5))
+        self.assertEquals([], watcher.changes(5))
+
+        reverted = dict(changed, memberUid=['norangsh'])
+        controller.get_groups_changed_since.return_value = [reverted]
+        self.assertEquals([reverted], watcher.changes(5))
@@ -0,0 +1,57 @@
+"""Pacing of the writes sync_ldap_groups makes to RT
+
+A large reconciliation writes as fast as the database commits, which
+RT's users notice as slow page loads. WriteThrottle picks the size of
+every batch apply_changes writes, and pauses between batches, from how
+long the previous batch took to commit.
+"""
+import time
+
+from rt_ldap_sync.models import DEFAULT_BATCH_SIZE
+
+# Largest batch grown to by default, Django 1.4's bulk_create inserts a
+# batch as one compound SELECT on SQLite, which allows 500 terms
+MAX_BATCH_SIZE = 500
+
+
+class WriteThrottle(object):
+    """Keeps batch commits under target_latency and the write rate under max_rows_per_second
+
+    A batch committed within target_latency grows the next one by a
+    tenth, a slower one halves it and is followed by a pause as long as
+    it overshot, to give RT's own queries a turn. Growing by a tenth and
+    shrinking by half, the size settles just under the budget.
+
+    :target_latency seconds a batch may take to commit, None for no limit
+    :max_rows_per_second rows written per second, None for no limit
+    :max_batch_size largest batch, ten times batch_size by default but
+    not beyond MAX_BATCH_SIZE unless batch_size already is
+    """
+    def __init__(self, target_latency=None, max_rows_per_second=None, batch_size=DEFAULT_BATCH_SIZE,
+                 min_batch_size=1, max_batch_size=None, sleep=time.sleep):
+        self.target_latency = target_latency
+        self.max_rows_per_second = max_rows_per_second
+        self.batch_size = batch_size
+        self.min_batch_size = min_batch_size
+        if not max_batch_size:
+            max_batch_size = max(batch_size, min(batch_size * 10, MAX_BATCH_SIZE))
+        self.max_batch_size = max_batch_size
+        # Seconds slept so far
+        self.paused = 0.0
+        self._sleep = sleep
+
+    def after_batch(self, rows, seconds):
+        """Adapts to a batch of rows that took seconds to commit, pausing if needed"""
+        pause = 0.0
+        if self.target_latency:
+            if seconds > self.target_latency:
+                self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+                pause = seconds - self.target_latency
+            else:
+                self.batch_size = min(self.max_batch_size, self.batch_size + max(1, self.batch_size // 10))
+        if self.max_rows_per_second:
+            # The time the batch should have taken at the allowed rate
+            pause = max(pause, float(rows) / self.max_rows_per_second - seconds)
+        if pause > 0:
+            self._sleep(pause)
+            self.paused += pause
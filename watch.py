@@ -0,0 +1,147 @@
+"""Change feeds for sync_ldap_groups --daemon
+
+A watcher returns the posixGroup entries that changed in LDAP, either
+from a persistent search or by polling modifyTimestamp, and
+GroupChangeCoalescer batches them so a burst of changes to the same
+groups is applied to RT once.
+"""
+from __future__ import absolute_import
+
+import logging
+import time
+
+import ldap
+
+logger = logging.getLogger('rt_ldap_sync')
+
+
+class GroupChangeCoalescer(object):
+    """Collects changed groups and releases them in batches
+
+    Changes to the same group are merged, the newest entry wins. A batch
+    is ready debounce seconds after the last change, or max_delay seconds
+    after the first one if changes keep coming.
+    """
+    def __init__(self, debounce=2.0, max_delay=30.0, clock=time.time):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self._clock = clock
+        self._pending = {}
+        self._first_change = None
+        self._last_change = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, entry):
+        now = self._clock()
+        for groupname in entry.get('cn', []):
+            self._pending[groupname] = entry
+        if self._first_change is None:
+            self._first_change = now
+        self._last_change = now
+
+    def wait_time(self, idle=None):
+        """Seconds until the pending batch is ready, idle if nothing is pending"""
+        if not self._pending:
+            return idle
+        now = self._clock()
+        return max(0, min(self._last_change + self.debounce, self._first_change + self.max_delay) - now)
+
+    def ready(self):
+        return bool(self._pending) and self.wait_time() == 0
+
+    def pop(self):
+        """Returns the pending batch as a dict of group name -> entry"""
+        pending = self._pending
+        self._pending = {}
+        self._first_change = self._last_change = None
+        return pending
+
+
+class PollingGroupWatcher(object):
+    """Asks LDAP for groups with a newer modifyTimestamp every interval seconds"""
+    def __init__(self, controller, since=None, interval=10.0, clock=time.time, sleep=time.sleep):
+        self.high_water_mark = since
+        self.interval = interval
+        self._controller = controller
+        self._clock = clock
+        self._sleep = sleep
+        self._next_poll = clock()
+        # The entry last returned for each group at high_water_mark, the >=
+        # filter would otherwise return them again on every poll. Whole
+        # entries are compared, modifyTimestamp only has a resolution of
+        # a second and a group changed again within it must not be skipped
+        self._seen_at_mark = {}
+
+    def changes(self, timeout):
+        """Waits at most timeout seconds for the next poll
+
+        :returns the groups changed since the previous poll"""
+        wait = self._next_poll - self._clock()
+        if wait > 0:
+            self._sleep(min(wait, timeout))
+            if self._clock() < self._next_poll:
+                return []
+        self._next_poll = self._clock() + self.interval
+        return self.poll()
+
+    def poll(self):
+        """Returns the groups changed since the previous poll, without waiting"""
+        return self.seen(self._controller.get_groups_changed_since(self.high_water_mark))
+
+    def seen(self, entries):
+        """Moves high_water_mark past entries
+
+        :returns the entries not seen at high_water_mark before"""
+        changes = []
+        for entry in entries:
+            timestamp = max(entry.get('modifyTimestamp', ['']))
+            group = tuple(entry.get('cn', []))
+            key = tuple(sorted((attribute.lower(), tuple(sorted(values))) for attribute, values in entry.items()))
+            if timestamp == self.high_water_mark and self._seen_at_mark.get(group) == key:
+                continue
+            changes.append((group, key, timestamp, entry))
+
+        for group, key, timestamp, entry in changes:
+            if timestamp > self.high_water_mark:
+                self.high_water_mark = timestamp
+                self._seen_at_mark = {}
+        self._seen_at_mark.update((group, key) for group, key, timestamp, entry in changes
+                                  if timestamp == self.high_water_mark)
+        return [entry for group, key, timestamp, entry in changes]
+
+
+class PersistentSearchGroupWatcher(object):
+    """Receives changed groups from the directory as they happen
+
+    Servers without persistent search (OpenLDAP only offers syncrepl)
+    reject the control, the watcher then switches to fallback. Whenever
+    the search (re)starts, fallback polls once for the changes made
+    before it, since the sync before or while the connection was lost.
+    Other LDAP errors are raised, the search is restarted on the next
+    call.
+    """
+    def __init__(self, controller, fallback):
+        self._controller = controller
+        self._fallback = fallback
+
+    def changes(self, timeout):
+        if self._controller is None:
+            return self._fallback.changes(timeout)
+        try:
+            if self._controller.start_group_changes():
+                return self._fallback.poll()
+            return self._fallback.seen(list(self._controller.iter_group_changes(timeout)))
+        except (ldap.UNAVAILABLE_CRITICAL_EXTENSION, ldap.PROTOCOL_ERROR), e:
+            logger.warning('Persistent search not supported, polling instead: %s', e)
+            self._controller = None
+            return self._fallback.changes(timeout)
+
+
+def make_group_watcher(controller, since=None, poll_interval=10.0):
+    """Persistent search when the directory connection supports it, polling otherwise"""
+    polling = PollingGroupWatcher(controller, since, poll_interval)
+    if controller.supports_persistent_search():
+        return PersistentSearchGroupWatcher(controller, polling)
+    return polling